@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+#  Micro benchmark of the syncfiles.py ignore engine
+#
+#  Compares the compiled gitignore matcher against the previous approach
+#  (linear scan of path prefixes plus fnmatch of every pattern for every file)
+#
+
+import os
+import sys
+import time
+import random
+import fnmatch
+import argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'bin' ) )
+import syncfiles
+
+BASEDIR = '/base'
+
+def generate_rules(count,rand):
+    rv = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            rv.append( 'dir{}/sub{}'.format( i, rand.randint(0,9) ) )
+        elif kind == 1:
+            rv.append( '*.ext{}'.format( i ) )
+        elif kind == 2:
+            rv.append( 'file{}~'.format( i ) )
+        else:
+            rv.append( '*/cache{}/*'.format( i ) )
+    return rv
+
+def generate_paths(count,rand):
+    rv = []
+    for i in range(count):
+        depth = rand.randint(1,5)
+        components = [ 'dir{}'.format( rand.randint(0,300) ) for _ in range(depth) ]
+        components.append( 'file{}.ext{}'.format( i, rand.randint(0,400) ) )
+        rv.append( os.path.join( BASEDIR, *components ) )
+    return rv
+
+def legacy_ignore(paths,rules):
+    '''
+    the original should_ignore: rules without wildcard behave as existing path prefixes
+    '''
+    ignore_map = { os.path.join( BASEDIR, x ):1 for x in rules if not any( c in x for c in '*?[' ) }
+    ignore_pattern = { x:1 for x in rules if x not in ignore_map and any( c in x for c in '*?[' ) }
+
+    def should_ignore(filepath):
+        for ignore_path in ignore_map:
+            if filepath.startswith( ignore_path ):
+                return True
+        for pattern in ignore_pattern:
+            if fnmatch.fnmatch( filepath, pattern ):
+                return True
+        return False
+
+    return sum( 1 for x in paths if should_ignore( x ) )
+
+def compiled_ignore(paths,rules):
+    matcher = syncfiles.compile_ignore( tuple( rules ) )
+    prefix = len(BASEDIR) + 1
+    return sum( 1 for x in paths if matcher.match( x[prefix:] ) )
+
+def timeit(fn,*args):
+    start = time.perf_counter()
+    rv = fn(*args)
+    return (time.perf_counter() - start, rv)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description='Benchmark ignore rules matching' )
+    parser.add_argument( '-p', '--paths', type=int, default=10000, help='number of paths' )
+    parser.add_argument( '-r', '--rules', type=int, default=200, help='number of ignore rules' )
+    parser.add_argument( '-s', '--seed', type=int, default=0 )
+    args = parser.parse_args()
+
+    rand = random.Random( args.seed )
+    rules = generate_rules( args.rules, rand )
+    paths = generate_paths( args.paths, rand )
+
+    (legacy_time, legacy_count) = timeit( legacy_ignore, paths, rules )
+    (compile_time, _) = timeit( syncfiles.compile_ignore, tuple( rules ) )
+    (compiled_time, compiled_count) = timeit( compiled_ignore, paths, rules )
+
+    print( '{} paths x {} rules'.format( len(paths), len(rules) ) )
+    print( 'legacy:   {:8.3f}s {} ignored'.format( legacy_time, legacy_count ) )
+    print( 'compiled: {:8.3f}s {} ignored (compile {:.3f}s)'.format( compiled_time, compiled_count, compile_time ) )
+    print( 'speedup:  {:8.1f}x'.format( legacy_time / compiled_time if compiled_time > 0 else 0.0 ) )
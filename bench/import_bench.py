@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#
+#  Startup benchmark of the bin/ scripts
+#
+#  Summarizes `python -X importtime` for each script (modules loaded by
+#  `--help`) and measures the time to first output of `syncfiles.py status`
+#  on a small synthetic tree. With --check the exit status is 1 if status
+#  takes longer than the budget
+#
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+BINDIR = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'bin' )
+
+def import_times(script,top):
+    '''
+    run `script --help` under -X importtime, returns the total and the slowest top level imports
+    '''
+    out = subprocess.run( [ sys.executable, '-X', 'importtime', os.path.join( BINDIR, script ), '--help' ],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=BINDIR )
+    modules = []
+    for line in out.stderr.decode( 'utf-8', 'replace' ).splitlines():
+        if not line.startswith( 'import time:' ) or 'cumulative' in line:
+            continue
+        (_,cumulative_us,name) = line.split( '|' )
+        # only the top level imports, nested ones are included in their cumulative time
+        if name.startswith( '  ' ):
+            continue
+        modules.append( (name.strip(), int( cumulative_us )) )
+    modules.sort( key=lambda x: -x[1] )
+    return {
+        'ok':out.returncode == 0,
+        'total_ms':round( sum( x[1] for x in modules ) / 1000.0, 1 ),
+        'slowest':[ { 'module':name, 'ms':round( us / 1000.0, 1 ) } for (name,us) in modules[:top] ],
+    }
+
+def first_output_ms(cmd,cwd,env):
+    '''
+    milliseconds from starting cmd to its first byte of output
+    '''
+    start = time.perf_counter()
+    process = subprocess.Popen( cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL )
+    process.stdout.read( 1 )
+    rv = ( time.perf_counter() - start ) * 1000.0
+    process.stdout.read()
+    process.wait()
+    return rv
+
+def status_time(runs):
+    sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+    import syncfiles_bench
+
+    root = tempfile.mkdtemp( prefix='syncfiles-import-' )
+    try:
+        tree_args = argparse.Namespace( seed=0, sizes='1k', dirmaps=2, files=50, drift=0.1, rules=5 )
+        syncfiles_bench.generate_tree( root, tree_args )
+        env = dict( os.environ, XDG_CACHE_HOME=os.path.join( root, 'cache' ), XDG_DATA_HOME=os.path.join( root, 'data' ) )
+        cmd = [ sys.executable, os.path.join( BINDIR, 'syncfiles.py' ), 'status' ]
+        # first run fills the hash cache
+        first_output_ms( cmd, os.path.join( root, 'repo' ), env )
+        times = [ first_output_ms( cmd, os.path.join( root, 'repo' ), env ) for _ in range(runs) ]
+    finally:
+        shutil.rmtree( root, ignore_errors=True )
+    return { 'runs':runs, 'median_ms':round( statistics.median( times ), 1 ), 'min_ms':round( min( times ), 1 ) }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description='Benchmark startup time of the bin scripts' )
+    parser.add_argument( 'scripts', nargs='*', default=[ 'syncfiles.py', 'lancheck.py', 'unifi.py' ] )
+    parser.add_argument( '-n', '--runs', type=int, default=10, help='number of syncfiles.py status runs' )
+    parser.add_argument( '--top', type=int, default=5, help='number of slowest imports to report' )
+    parser.add_argument( '--check', type=float, metavar='MS', help='exit with 1 if the median status time is above MS' )
+    args = parser.parse_args()
+
+    report = {
+        'python':sys.version.split()[0],
+        'imports':{ x:import_times( x, args.top ) for x in args.scripts },
+        'syncfiles_status':status_time( args.runs ),
+    }
+    print( json.dumps( report, indent=2 ) )
+
+    if args.check is not None and report['syncfiles_status']['median_ms'] > args.check:
+        print( 'syncfiles.py status took {}ms, budget {}ms'.format( report['syncfiles_status']['median_ms'], args.check ), file=sys.stderr )
+        sys.exit( 1 )
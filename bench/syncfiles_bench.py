@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+#
+#  End to end benchmark of syncfiles.py on a synthetic setup
+#
+#  Generates a git repo with a .syncfiles mapping N dirmaps to source
+#  directories, then times discovery, status and sync and reports them as
+#  json. Each phase runs in its own python process so its peak RSS is its own.
+#  Per phase: wall time, the read and write syscall counters and bytes read
+#  from /proc/self/io (other syscalls are not counted, nor git children),
+#  and the peak RSS before and after the phase
+#
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import resource
+import subprocess
+import contextlib
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'bin' ) )
+import syncfiles
+
+def parse_sizes(spec):
+    '''
+    size distribution as SIZE:WEIGHT,... for example 1k:90,64k:9,4m:1
+    '''
+    units = { 'k':1024, 'm':1024*1024, 'g':1024*1024*1024 }
+    rv = []
+    for item in spec.split( ',' ):
+        (size,_,weight) = item.partition( ':' )
+        size = size.lower()
+        mult = units.get( size[-1:], 1 )
+        if size[-1:] in units:
+            size = size[:-1]
+        rv.append( (int(float(size) * mult), float(weight or 1)) )
+    return rv
+
+def write_file(path,size,rand):
+    os.makedirs( os.path.dirname( path ), exist_ok=True )
+    with open( path, 'wb' ) as of:
+        of.write( rand.randbytes( size ) if hasattr( rand, 'randbytes' ) else os.urandom( size ) )
+
+def generate_tree(root,args):
+    '''
+    create root/repo with its .syncfiles and root/src/dirN the dirmaps point to,
+    returns a summary of what was generated
+    '''
+    rand = random.Random( args.seed )
+    sizes = parse_sizes( args.sizes )
+    repo = os.path.join( root, 'repo' )
+    os.makedirs( repo )
+
+    dirmap = {}
+    for d in range(args.dirmaps):
+        dirmap[ 'dir{}'.format( d ) ] = os.path.join( root, 'src', 'dir{}'.format( d ) )
+    rules = [ '*.ignored{}'.format( i ) for i in range(args.rules) ]
+
+    total = 0
+    drifted = 0
+    for i in range(args.files):
+        d = i % args.dirmaps
+        rel = os.path.join( 'sub{}'.format( rand.randint( 0, 9 ) ), 'file{}.txt'.format( i ) )
+        size = rand.choices( [ x[0] for x in sizes ], weights=[ x[1] for x in sizes ] )[0]
+        repo_file = os.path.join( repo, 'dir{}'.format( d ), rel )
+        src_file = os.path.join( dirmap[ 'dir{}'.format( d ) ], rel )
+        write_file( repo_file, size, rand )
+        if rand.random() < args.drift:
+            write_file( src_file, size, rand )
+            drifted += 1
+        else:
+            os.makedirs( os.path.dirname( src_file ), exist_ok=True )
+            shutil.copyfile( repo_file, src_file )
+        if rules and rand.random() < 0.1:
+            ignored = '{}.{}'.format( rel, rules[ rand.randrange( len(rules) ) ][2:] )
+            write_file( os.path.join( repo, 'dir{}'.format( d ), ignored ), 16, rand )
+        total += size
+
+    with open( os.path.join( repo, '.syncfiles' ), 'w' ) as of:
+        json.dump( { 'dirmap':dirmap, 'ignore':rules }, of )
+
+    # backdate everything so the hash cache does not treat the files as racily modified
+    settled = time.time() - 60
+    for (dirpath,dirnames,filenames) in os.walk( root ):
+        for name in filenames:
+            os.utime( os.path.join( dirpath, name ), (settled,settled) )
+
+    git = [ 'git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost' ]
+    subprocess.run( git + [ 'init', '-q' ], cwd=repo, check=True )
+    subprocess.run( git + [ 'add', '-A' ], cwd=repo, check=True )
+    subprocess.run( git + [ 'commit', '-q', '-m', 'synthetic tree' ], cwd=repo, check=True )
+
+    return { 'dirmaps':args.dirmaps, 'files':args.files, 'bytes':total, 'drifted':drifted, 'rules':len(rules) }
+
+def proc_io():
+    rv = {}
+    try:
+        with open( '/proc/self/io', 'r' ) as f:
+            for line in f:
+                (key,_,value) = line.partition( ':' )
+                rv[key] = int( value )
+    except OSError:
+        pass
+    return rv
+
+def measure(fn):
+    '''
+    run fn with stdout discarded and return its wall time and resource usage,
+    meant to run in a fresh process, see run_phase
+    '''
+    start_rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    before = proc_io()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout( io.StringIO() ):
+        rv = fn()
+    elapsed = time.perf_counter() - start
+    after = proc_io()
+    usage = resource.getrusage( resource.RUSAGE_SELF )
+    return {
+        'seconds':round( elapsed, 6 ),
+        'read_syscalls':after.get( 'syscr', 0 ) - before.get( 'syscr', 0 ),
+        'write_syscalls':after.get( 'syscw', 0 ) - before.get( 'syscw', 0 ),
+        'bytes_read':after.get( 'rchar', 0 ) - before.get( 'rchar', 0 ),
+        'start_rss_kb':start_rss,
+        'peak_rss_kb':usage.ru_maxrss,
+        'result':rv,
+    }
+
+def run_phase(name,args,repo):
+    '''
+    measure one phase in a new python process, the state it needs (hash cache,
+    manifest) is on disk from the previous phases
+    '''
+    cmd = [ sys.executable, os.path.abspath( __file__ ), '--phase', name, '-j', str(args.jobs) ]
+    out = subprocess.run( cmd, cwd=repo, stdout=subprocess.PIPE, check=True )
+    return json.loads( out.stdout )
+
+def config(argv):
+    return syncfiles.Config( syncfiles.build_parser().parse_args( argv ) )
+
+def phase_discover():
+    return sum( 1 for _ in config( [ 'status', '--nogit' ] ).discover_file_pairs() )
+
+def phase_git_pairs():
+    return len( config( [ 'status' ] ).construct_git_pairs() )
+
+def phase_status(jobs):
+    c = config( [ 'status', '-j', str(jobs) ] )
+    c.cmd_status()
+    c.save_state()
+
+def phase_sync(jobs):
+    c = config( [ 'sync', '-e', '--nosnapshot', '-j', str(jobs) ] )
+    c.cmd_sync()
+    c.save_state()
+
+PHASES = {
+    'discover_file_pairs':lambda args: phase_discover(),
+    'construct_git_pairs':lambda args: phase_git_pairs(),
+    'status_cold':lambda args: phase_status( args.jobs ),
+    'status_warm':lambda args: phase_status( args.jobs ),
+    'sync':lambda args: phase_sync( args.jobs ),
+    'status_after_sync':lambda args: phase_status( args.jobs ),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description='Benchmark syncfiles.py on a synthetic tree' )
+    parser.add_argument( '-d', '--dirmaps', type=int, default=4, help='number of dirmaps' )
+    parser.add_argument( '-n', '--files', type=int, default=2000, help='number of files' )
+    parser.add_argument( '--sizes', default='1k:90,64k:9,1m:1', help='size distribution SIZE:WEIGHT,...' )
+    parser.add_argument( '--drift', type=float, default=0.1, help='fraction of source files that differ' )
+    parser.add_argument( '-r', '--rules', type=int, default=50, help='number of ignore rules' )
+    parser.add_argument( '-j', '--jobs', type=int, default=1, help='--jobs passed to status and sync' )
+    parser.add_argument( '-s', '--seed', type=int, default=0 )
+    parser.add_argument( '-o', '--output', help='write the json to that file instead of stdout' )
+    parser.add_argument( '--keep', action='store_true', help='keep the generated tree' )
+    parser.add_argument( '--phase', choices=list(PHASES), help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.phase:
+        # child process of run_phase, started in the repo with the environment set
+        print( json.dumps( measure( lambda: PHASES[args.phase]( args ) ) ) )
+        sys.exit( 0 )
+
+    root = tempfile.mkdtemp( prefix='syncfiles-bench-' )
+    try:
+        os.environ['XDG_CACHE_HOME'] = os.path.join( root, 'cache' )
+        os.environ['XDG_DATA_HOME'] = os.path.join( root, 'data' )
+        tree = generate_tree( root, args )
+
+        results = {}
+        for name in PHASES:
+            results[name] = run_phase( name, args, os.path.join( root, 'repo' ) )
+            if results[name]['result'] is None:
+                del results[name]['result']
+    finally:
+        if args.keep:
+            print( 'tree kept in {}'.format( root ), file=sys.stderr )
+        else:
+            shutil.rmtree( root, ignore_errors=True )
+
+    report = {
+        'timestamp':time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+        'python':sys.version.split()[0],
+        'jobs':args.jobs,
+        'seed':args.seed,
+        'tree':tree,
+        'phases':results,
+    }
+    if args.output:
+        with open( args.output, 'w' ) as of:
+            json.dump( report, of, indent=2 )
+            of.write( '\n' )
+    else:
+        print( json.dumps( report, indent=2 ) )
@@ -27,14 +27,21 @@
 #
 
 import csv
+import sys
 import os
 import datetime
+import time
+import tempfile
 import json
 import argparse
 import xml.etree.ElementTree as ET
 import pprint
+import pickle
+import hashlib
 import subprocess
-from socket import inet_aton
+import ipaddress
+import sqlite3
+from socket import inet_aton, inet_ntoa, inet_pton, AF_INET6
 import re
 from collections import defaultdict
 
@@ -50,36 +57,201 @@ def json_serial_defaults(obj):
 
     raise TypeError( "Type %s not serializable" %(type(obj),))
 
-def mac_vendor(mac):
+def cache_dir():
+    cache = os.environ.get( 'XDG_CACHE_HOME' ) or os.path.expanduser( '~/.cache' )
+    return os.path.join( cache, 'lancheck' )
+
+def nmap_mac_prefixes():
     prefixes = '/usr/local/share/nmap/nmap-mac-prefixes'
     if not os.path.isfile( prefixes ):
         prefixes = '/usr/share/nmap/nmap-mac-prefixes'
+    return prefixes
 
-    macpref = mac.upper().replace(':', '')[:6]
+class VendorIndex:
+    '''
+    vendor by mac prefix from nmap-mac-prefixes. The prefixes are 6 (MA-L, 24 bits),
+    7 (MA-M, 28 bits) or 9 (MA-S, 36 bits) hex characters, the longest one matching wins.
+    The parsed index is pickled in the cache dir and rebuilt when the source file changes
+    '''
+    VERSION = 1
+    
+    def __init__(self,source,by_length):
+        self.source = source
+        self.by_length = by_length
+        self.lengths = sorted( by_length.keys(), reverse=True )
 
-    found = None
-    if os.path.isfile( prefixes ):
-        with open( prefixes, 'r') as fp:
-            line = fp.readline()
-            while( line ):
-                if line.startswith(macpref):
-                    found = line[7:].rstrip()
-                    break
-                line = fp.readline()
+    @staticmethod
+    def parse(source):
+        by_length = defaultdict(dict)
+        with open( source, 'r', encoding='utf-8', errors='replace' ) as fp:
+            for line in fp:
+                if line.startswith( '#' ):
+                    continue
+                parts = line.rstrip().split( None, 1 )
+                if len(parts) == 2:
+                    prefix = parts[0].upper()
+                    by_length[len(prefix)][prefix] = parts[1]
+        return VendorIndex( source, dict(by_length) )
+
+    @staticmethod
+    def cache_path(source):
+        return os.path.join( cache_dir(), 'vendors-{}.pickle'.format( hashlib.sha1( source.encode( 'utf-8' ) ).hexdigest()[:16] ) )
+
+    @staticmethod
+    def load(source):
+        st = os.stat( source )
+        key = (VendorIndex.VERSION, st.st_size, st.st_mtime_ns)
+        cache = VendorIndex.cache_path( source )
+        try:
+            with open( cache, 'rb' ) as fp:
+                (cached_key,by_length) = pickle.load( fp )
+            if cached_key == key:
+                return VendorIndex( source, by_length )
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+        rv = VendorIndex.parse( source )
+        try:
+            os.makedirs( os.path.dirname( cache ), exist_ok=True )
+            tmp = '{}.{}'.format( cache, os.getpid() )
+            with open( tmp, 'wb' ) as fp:
+                pickle.dump( (key,rv.by_length), fp, protocol=pickle.HIGHEST_PROTOCOL )
+            os.replace( tmp, cache )
+        except OSError:
+            pass
+        return rv
+
+    def lookup(self,mac):
+        hexmac = mac.upper().replace(':', '').replace('-', '')
+        for length in self.lengths:
+            found = self.by_length[length].get( hexmac[:length] )
+            if found:
+                return found
+        return None
+
+_vendor_index = None
 
-    return found
+def vendor_index():
+    '''
+    the VendorIndex for the installed nmap-mac-prefixes, None if nmap is not installed
+    '''
+    global _vendor_index
+    if _vendor_index is None:
+        prefixes = nmap_mac_prefixes()
+        _vendor_index = VendorIndex.load( prefixes ) if os.path.isfile( prefixes ) else False
+    return _vendor_index or None
+
+def mac_vendor(mac):
+    index = vendor_index()
+    return index.lookup( mac ) if index else None
     
+MISSING = object()
+
+def encode_mac(mac):
+    '''
+    48 bits int for a mac in the canonical AA:BB:CC:DD:EE:FF form, anything else is kept as is
+    '''
+    if isinstance(mac, str) and len(mac) == 17:
+        try:
+            value = int( mac.replace(':', ''), 16 )
+        except ValueError:
+            return mac
+        if decode_mac(value) == mac:
+            return value
+    return mac
+
+def decode_mac(value):
+    if isinstance(value, int):
+        hexmac = '%012X' % (value,)
+        return ':'.join( [ hexmac[i:i+2] for i in range(0,12,2) ] )
+    return value
+
+def encode_ipv4(ip):
+    '''
+    32 bits int for an ip in the canonical dotted form, anything else (ipv6, empty) is kept as is
+    '''
+    if isinstance(ip, str) and 7 <= len(ip) <= 15:
+        try:
+            value = int.from_bytes( inet_aton(ip), 'big' )
+        except OSError:
+            return ip
+        if decode_ipv4(value) == ip:
+            return value
+    return ip
+
+def decode_ipv4(value):
+    if isinstance(value, int):
+        return inet_ntoa( value.to_bytes(4, 'big') )
+    return value
+
 class Device:
+    '''
+    the common fields are slots, with mac and ipv4 stored as int when they are in
+    canonical form, any other field goes in the extra dict
+    '''
+    __slots__ = ( '_mac', '_ipv4', '_name', '_hostname', '_vendor', '_model', '_firstseen', 'extra', 'changed' )
+
+    FIELDS = { 'mac':'_mac', 'ipv4':'_ipv4', 'name':'_name', 'hostname':'_hostname', 'vendor':'_vendor', 'model':'_model', 'firstseen':'_firstseen' }
+
     def __init__(self,info):
-        self.info = dict(info)
+        self._mac = MISSING
+        self._ipv4 = MISSING
+        self._name = MISSING
+        self._hostname = MISSING
+        self._vendor = MISSING
+        self._model = MISSING
+        self._firstseen = MISSING
+        self.extra = None
         self.changed = {}
-        if 'firstseen' in self.info and isinstance(self.info['firstseen'], str):
-            self.info['firstseen'] = datetime.datetime.strptime(self.info['firstseen'], '%Y-%m-%dT%H:%M:%S.%f')
-            
+        for key,value in info.items():
+            self.set_field( key, value )
+        if isinstance(self._firstseen, str):
+            self._firstseen = datetime.datetime.strptime(self._firstseen, '%Y-%m-%dT%H:%M:%S.%f')
+
+    def get_field(self,key):
+        '''
+        value of the field or MISSING
+        '''
+        slot = Device.FIELDS.get( key )
+        if slot is None:
+            return self.extra.get( key, MISSING ) if self.extra else MISSING
+        if key == 'mac':
+            return decode_mac( self._mac )
+        if key == 'ipv4':
+            return decode_ipv4( self._ipv4 )
+        return getattr( self, slot )
+
+    def set_field(self,key,value):
+        slot = Device.FIELDS.get( key )
+        if slot is None:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[ sys.intern(key) ] = value
+        elif key == 'mac':
+            self._mac = encode_mac( value )
+        elif key == 'ipv4':
+            self._ipv4 = encode_ipv4( value )
+        else:
+            setattr( self, slot, value )
+
+    @property
+    def info(self):
+        '''
+        all the fields as a new dict
+        '''
+        rv = {}
+        for key in Device.FIELDS:
+            value = self.get_field( key )
+            if value is not MISSING:
+                rv[key] = value
+        if self.extra:
+            rv.update( self.extra )
+        return rv
+
     def __getitem__(self,key):
-        rv = None
-        if key in self.info:
-            rv = self.info[key]
+        rv = self.get_field( key )
+        if rv is MISSING:
+            rv = None
 
         if key == 'vendor' and self.mac():
             if rv == None:
@@ -88,26 +260,76 @@ class Device:
         return rv
 
     def __setitem__(self,key,value):
-        if key in self.info and self.info[key] != value:
+        previous = self.get_field( key )
+        if previous is not MISSING and previous != value:
             # only record first change
             if key not in self.changed:
-                self.changed[key] = self.info[key]
-        self.info[key] = value
+                self.changed[key] = previous
+        self.set_field( key, value )
 
     def __delitem__(self,key):
-        del self.info[key]
+        slot = Device.FIELDS.get( key )
+        if slot is None:
+            if not self.extra:
+                raise KeyError( key )
+            del self.extra[key]
+        elif getattr( self, slot ) is MISSING:
+            raise KeyError( key )
+        else:
+            setattr( self, slot, MISSING )
         
     def __repr__(self):
         return 'Device(%s)' %(self.info,)
 
     def __str__(self):
-        return 'Device%s(%d keys)' %( [self.info[x] if x in self.info else '' for x in ( 'mac', 'ipv4', 'name', 'vendor') ], len(self.info),  )
+        values = [ self.get_field(x) for x in ( 'mac', 'ipv4', 'name', 'vendor') ]
+        return 'Device%s(%d keys)' %( [ '' if x is MISSING else x for x in values ], len(self.info),  )
 
     def __contains__(self,key):
-        return key in self.info
+        slot = Device.FIELDS.get( key )
+        if slot is None:
+            return bool(self.extra) and key in self.extra
+        return getattr( self, slot ) is not MISSING
     
     def mac(self):
-        return self.info['mac'] if 'mac' in self.info else None
+        return None if self._mac is MISSING else decode_mac( self._mac )
+
+    def mac_int(self):
+        '''
+        mac as a 48 bits int, -1 if missing or invalid
+        '''
+        if isinstance(self._mac, int):
+            return self._mac
+        try:
+            return int( self._mac.replace(':', '').replace('-', ''), 16 )
+        except (AttributeError, ValueError):
+            return -1
+
+    def ipv4_value(self):
+        '''
+        ipv4 as stored, 32 bits int when canonical, None if missing
+        '''
+        return None if self._ipv4 is MISSING else self._ipv4
+
+    def ip_sort_key(self):
+        '''
+        orders by ipv4, then ipv6 (in ipv4 or ipv6 field) and last the devices without ip
+        '''
+        if isinstance(self._ipv4, int):
+            return (0, self._ipv4)
+        ip = self._ipv4
+        if isinstance(ip, str) and ip:
+            try:
+                return (0, int.from_bytes( inet_aton( ip ), 'big' ))
+            except OSError:
+                pass
+        for ip in (self._ipv4, self.get_field( 'ipv6' )):
+            if isinstance(ip, str) and ip:
+                try:
+                    return (1, int.from_bytes( inet_pton( AF_INET6, ip.split('%')[0] ), 'big' ))
+                except OSError:
+                    pass
+        return (2, 0)
 
     def matches(self,key):
         for v in self.info.values():
@@ -118,11 +340,11 @@ class Device:
 
 
     def is_disabled(self):
-        return self.info['ipv4'] == '0.0.0.0'
+        return self._ipv4 == 0
 
     
     def record_as_new(self):
-        self.changed = dict(self.info)
+        self.changed = self.info
 
     def clear_changes(self):
         self.changed = {}
@@ -140,19 +362,20 @@ class Device:
         return self.changed == self.info
 
     def add_vendor(self):
-        pre = self.info['vendor'] if 'vendor' in self.info else None
+        pre =None if self._vendor is MISSING else self._vendor
         if not pre:
             vendor = mac_vendor(self.mac())
             if vendor:
-                self.info['vendor'] = vendor
+                self._vendor = vendor
     
     def show_changes(self,check=None):
         for key in self.changed:
             if not check or key in check:
-                if self.changed[key] == self.info[key]:
-                    print( 'new {}: {}'.format( key, self.info[key] ) )
+                value = self.get_field( key )
+                if self.changed[key] == value:
+                    print( 'new {}: {}'.format( key, value ) )
                 else:
-                    print( 'dif {}: {} -> {}'.format( key, self.changed[key], self.info[key] ) )
+                    print( 'dif {}: {} -> {}'.format( key, self.changed[key], value ) )
     
 class DeviceList:
     def __init__(self,devices):
@@ -169,6 +392,7 @@ class DeviceList:
                     self.devices_by_mac[ mac ] = device
                                               
         self.cols = None
+        self.orderings = {}
         self.changed = 0
         self.added = 0
 
@@ -176,10 +400,13 @@ class DeviceList:
         return 'DeviceList(%s)'  %( self.devices_list() , )
     
     def __str__(self):
-        return 'DeviceList( %d devices, [\n%s\n]' %( len(self.devices_by_mac), '\n'.join([str(x) for x in self.devices_list()]))
+        return 'DeviceList( %d devices, [\n%s\n]' %( len(self), '\n'.join([str(x) for x in self.devices_list()]))
 
     def __len__(self):
         return len(self.devices_by_mac)
+
+    def __iter__(self):
+        return iter(self.devices_by_mac.values())
     
     def __getitem__(self,key):
         if isinstance(key, int):
@@ -198,21 +425,31 @@ class DeviceList:
     def devices_list(self):
         return self.devices_by_mac.values()
 
+    def find(self,mac):
+        return self.devices_by_mac.get(mac)
+
     def devices_list_ordered_by(self,sortfield):
-        values = self.devices_by_mac.values()
+        '''
+        the sorted list is cached per field until update_with or add_missing_fields
+        '''
+        if sortfield in self.orderings:
+            return self.orderings[sortfield]
+
+        values = self.devices_list()
         if sortfield == 'mac':
-            sortkey = lambda x: (x[sortfield])
+            sortkey = lambda x: (x.mac_int(),x['mac'])
+        elif sortfield == 'ipv4':
+            sortkey = lambda x: (x.ip_sort_key(),x.mac_int())
         else:
             sortkey = lambda x: (str(x[sortfield]) if x[sortfield] else '',x['mac'])
-            if sortfield == 'ipv4':
-                sortkey = lambda x: (inet_aton(x[sortfield]),x['mac'])
                 
         sortedvalues = sorted( values, key=sortkey )
+        self.orderings[sortfield] = sortedvalues
         return sortedvalues
 
     def unknown_devices(self):
         rv = []
-        for mac,dev in self.devices_by_mac.items():
+        for dev in self.devices_list():
             if 'name' not in dev or dev['name'] == '':
                 rv += [dev]
                 
@@ -228,8 +465,17 @@ class DeviceList:
         return self.changed > 0 or self.added > 0
     
     def status(self):
-        return 'DeviceList(total=%d,changed=%d,added=%d)' %(len(self.devices_by_mac),self.changed, self.added)
+        return 'DeviceList(total=%d,changed=%d,added=%d)' %(len(self),self.changed, self.added)
     
+    @staticmethod
+    def load(fname,all=True):
+        '''
+        DeviceStore for a sqlite database (.db, .sqlite), else DeviceList from the json file
+        '''
+        if os.path.splitext(fname)[1] in ('.db', '.sqlite', '.sqlite3'):
+            return DeviceStore(fname, all=all)
+        return DeviceList.from_json(fname, all=all)
+
     @staticmethod
     def from_json(fname,all=True):
         devices = []
@@ -265,28 +511,42 @@ class DeviceList:
         take the output of sudo nmap -sn -oX list.xml 192.168.1.0/24 and create new array of dict
         will merge previous information if existing is provided
         '''
+        return DeviceList( DeviceList.iter_nmap_xml_file(fname) )
 
-        tree = ET.parse(fname)
-        root = tree.getroot()
+    @staticmethod
+    def iter_nmap_xml_file(fname):
+        '''
+        generate a Device for each host of the nmap xml output as soon as it is parsed,
+        each host is cleared once read so only one is in memory at a time.
+        Hosts without a mac or with a mac already seen are skipped
+        '''
+        done = set()
+        context = ET.iterparse(fname, events=('start','end'))
+        (_,root) = next(context)
 
-        all = []
-        done = {}
+        for (event,elem) in context:
+            if event != 'end' or elem.tag != 'host':
+                continue
+            found = DeviceList.device_from_nmap_host(elem)
+            root.clear()
 
-        for host in root.findall('host'):
-            found = Device({ 'firstseen':datetime.datetime.now()})
-            for addr in host.findall('address'):
-                found[ addr.attrib['addrtype'] ] = addr.attrib['addr']
-                if 'vendor' in addr.attrib:
-                    found['vendor']=addr.attrib['vendor']
+            mac = found.mac()
+            if mac and mac not in done:
+                done.add(mac)
+                yield found
 
-            for name in host.iter('hostname'):
-                found['hostname'] = name.attrib['name']
+    @staticmethod
+    def device_from_nmap_host(host):
+        info = { 'firstseen':datetime.datetime.now()}
+        for addr in host.findall('address'):
+            info[ addr.attrib['addrtype'] ] = addr.attrib['addr']
+            if 'vendor' in addr.attrib:
+                info['vendor']=addr.attrib['vendor']
 
-            if found.mac() and found.mac() not in done:
-                done[found.mac()] = 1
-                all.append(found)
+        for name in host.iter('hostname'):
+            info['hostname'] = name.attrib['name']
 
-        return DeviceList(all)
+        return Device(info)
 
     @staticmethod
     def from_wifi_json(fname):
@@ -330,17 +590,18 @@ class DeviceList:
             device.add_vendor()
             
         self.cols = None
+        self.orderings = {}
     
     def update_with( self, other, override=None):
         '''
-        will add new devices if they are missing.
+        will add new devices if they are missing, other is a DeviceList or any iterable of Device
         if not missing and override not None, will update corresponding fields
         '''
         for device in other:
             mac = device.mac()
             if mac:
-                if mac in self.devices_by_mac:
-                    found = self.devices_by_mac[mac]
+                found = self.find(mac)
+                if found is not None:
                     if override:
                         changed = False
                         for key in override:
@@ -355,6 +616,7 @@ class DeviceList:
                     device.record_as_new()
                     self.devices_by_mac[mac] = device
         self.cols = None
+        self.orderings = {}
 
     def extract_incomplete(self,live=None,keys=['name']):
         '''
@@ -365,8 +627,8 @@ class DeviceList:
         incomplete = []
         for device in live:
             mac = device.mac()
-            if mac in self.devices_by_mac:
-                existing = self.devices_by_mac[mac]
+            existing = self.find(mac)
+            if existing is not None:
 
                 hasMissing = False
 
@@ -384,7 +646,7 @@ class DeviceList:
         unique = {}
         for device in self.devices_list_ordered_by('ipv4'):
             ip = device['ipv4']
-            if ip not in unique:
+            if ip and ip not in unique:
                 unique[ip] = 1
                 of.write( ip+'\n' )
 
@@ -440,11 +702,11 @@ class DeviceList:
     def display_hosts(self):
         print( "# Hostnames" )
         for one in self.devices_list_ordered_by('ipv4'):
-            if 'hostname' in one:
+            if 'hostname' in one and one['ipv4']:
                 print( "{ipv4:13s}\t{hostname}".format(**one.info) )
         print( "# Aliases" )
         for one in self.devices_list_ordered_by('ipv4'):
-            if 'hostname_aliases' in one:
+            if 'hostname_aliases' in one and one['ipv4']:
                 aliases = one['hostname_aliases']
                 for alias in aliases:
                     print( "{ipv4:13s}\t{hostname}".format(ipv4=one['ipv4'],hostname=alias) )
@@ -452,10 +714,10 @@ class DeviceList:
     def display_static_host_mapping(self):
         jsondata = {}
         for one in self.devices_list_ordered_by('ipv4'):
-            if 'hostname' in one:
+            if 'hostname' in one and one['ipv4']:
                 jsondata[ one['hostname'] ] = { "inet": one['ipv4'] }
         for one in self.devices_list_ordered_by('ipv4'):
-            if 'hostname_aliases' in one:
+            if 'hostname_aliases' in one and one['ipv4']:
                 aliases = one['hostname_aliases']
                 for alias in aliases:
                     jsondata[ alias ] = { "inet": one['ipv4'] }
@@ -523,9 +785,541 @@ class DeviceList:
         return rv
 
 
+class DeviceStore(DeviceList):
+    '''
+    DeviceList kept in a sqlite database: devices are only read from the database
+    when looked up by mac, or all at once when the whole list is needed. save writes
+    back every device read or added in a single transaction
+    '''
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS devices (mac TEXT PRIMARY KEY, ipv4 TEXT, name TEXT, hostname TEXT, info TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS devices_ipv4 ON devices (ipv4)',
+        'CREATE INDEX IF NOT EXISTS devices_name ON devices (name)',
+        'CREATE INDEX IF NOT EXISTS devices_hostname ON devices (hostname)',
+    ]
+    LOOKUP_FIELDS = ( 'ipv4', 'name', 'hostname' )
+
+    def __init__(self,fname,all=True):
+        super().__init__([])
+        self.fname = fname
+        self.all = all
+        self.loaded = False
+        self.stored = set()
+        self.db = sqlite3.connect( fname )
+        with self.db:
+            for sql in DeviceStore.SCHEMA:
+                self.db.execute( sql )
+
+    def __len__(self):
+        if self.loaded:
+            return len(self.devices_by_mac)
+        unsaved = sum( 1 for x in self.devices_by_mac if x not in self.stored )
+        return self.query( 'SELECT COUNT(*) FROM devices' ).fetchone()[0] + unsaved
+
+    def __iter__(self):
+        return iter(self.devices_list())
+
+    def __getitem__(self,key):
+        if isinstance(key, int):
+            return list(self.devices_list())[key]
+        elif isinstance(key, str):
+            found = self.find(key)
+            if found is None:
+                raise KeyError(key)
+            return found
+
+        return None
+
+    def __contains__(self,key):
+        if isinstance(key, int):
+            return key < len(self)
+        elif isinstance(key, str):
+            return self.find(key) is not None
+
+    def query(self,sql,params=(),where=None):
+        '''
+        run sql with the where conditions, excluding disabled devices unless all
+        '''
+        conditions = [ where ] if where else []
+        if not self.all:
+            conditions.append( "(ipv4 IS NULL OR ipv4 != '0.0.0.0')" )
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join( conditions )
+        return self.db.execute( sql, params )
+
+    def device_from_row(self,mac,info):
+        rv = self.devices_by_mac.get( mac )
+        if rv is None:
+            rv = Device( json.loads( info ) )
+            self.devices_by_mac[mac] = rv
+        self.stored.add( mac )
+        return rv
+
+    def find(self,mac):
+        found = self.devices_by_mac.get( mac )
+        if found is None and not self.loaded:
+            row = self.query( 'SELECT mac, info FROM devices', (mac,), 'mac = ?' ).fetchone()
+            if row:
+                found = self.device_from_row( *row )
+        return found
+
+    def find_by(self,field,value):
+        '''
+        DeviceList of the devices with field equal to value, field is one of LOOKUP_FIELDS
+        '''
+        if field not in DeviceStore.LOOKUP_FIELDS:
+            raise ValueError( 'Cannot lookup by {}, use one of {}'.format( field, ', '.join( DeviceStore.LOOKUP_FIELDS ) ) )
+        rows = self.query( 'SELECT mac, info FROM devices', (value,), '{} = ?'.format( field ) ).fetchall()
+        return DeviceList( [ self.device_from_row( mac, info ) for (mac,info) in rows ] )
+
+    def devices_list(self):
+        if not self.loaded:
+            for (mac,info) in self.query( 'SELECT mac, info FROM devices' ):
+                self.device_from_row( mac, info )
+            self.loaded = True
+        return self.devices_by_mac.values()
+
+    def col_width(self):
+        '''
+        computed by sqlite from the stored json without reading every device
+        '''
+        if self.cols:
+            return self.cols
+        if self.loaded:
+            return super().col_width()
+
+        rv = defaultdict(int)
+        sql = 'SELECT j.key, MAX(LENGTH(CAST(j.value AS TEXT))) FROM devices, json_each(devices.info) AS j'
+        conditions = [] if self.all else [ "(ipv4 IS NULL OR ipv4 != '0.0.0.0')" ]
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join( conditions )
+        for (field,width) in self.db.execute( sql + ' GROUP BY j.key' ):
+            rv[field] = width or 0
+        for x in self.devices_by_mac.values():
+            for field,val in x.info.items():
+                rv[field] = max(rv[field],len(str(val)))
+        self.cols = rv
+        return rv
+
+    @staticmethod
+    def device_row(device):
+        values = [ device.get_field( x ) for x in DeviceStore.LOOKUP_FIELDS ]
+        values = [ None if x is MISSING else x for x in values ]
+        return [ device.mac() ] + values + [ json.dumps( device.info, default = json_serial_defaults, sort_keys=True ) ]
+
+    def write(self,devices):
+        with self.db:
+            self.db.executemany( 'INSERT OR REPLACE INTO devices (mac, ipv4, name, hostname, info) VALUES (?,?,?,?,?)',
+                                 [ DeviceStore.device_row( x ) for x in devices ] )
+        self.stored.update( [ x.mac() for x in devices ] )
+
+    def save(self):
+        self.write( list(self.devices_by_mac.values()) )
+
+    def save_as_json(self,fname):
+        '''
+        save to the database if fname is the database, else export all the devices as json
+        '''
+        if os.path.abspath( fname ) == os.path.abspath( self.fname ):
+            self.save()
+        else:
+            super().save_as_json(fname)
+
+    def import_json(self,fname):
+        '''
+        insert or replace all the devices of the json file, returns the number of devices
+        '''
+        devices = list( DeviceList.from_json( fname, all=True ) )
+        self.write( devices )
+        for device in devices:
+            self.devices_by_mac[device.mac()] = device
+        self.cols = None
+        self.orderings = {}
+        return len(devices)
+
+ATF_PERM = 0x4
+NEIGH_PRESENT = ('REACHABLE','DELAY','PROBE','PERMANENT')
+
+def parse_proc_arp(text):
+    '''
+    dict ip -> (mac, present) from the content of /proc/net/arp, skipping incomplete
+    entries. A complete entry stays for minutes after the host left, so only the
+    permanent ones say the host is present
+    '''
+    rv = {}
+    for line in text.splitlines()[1:]:
+        parts = line.split()
+        if len(parts) >= 4 and parts[2] != '0x0' and parts[3] != '00:00:00:00:00:00':
+            rv[parts[0]] = (parts[3].upper(), bool( int( parts[2], 16 ) & ATF_PERM ))
+    return rv
+
+def parse_ip_neigh(text):
+    '''
+    dict ip -> (mac, present) from the output of `ip neigh`, skipping entries without
+    lladdr. Only the states in NEIGH_PRESENT say the host is present, a STALE entry
+    only gives its mac
+    '''
+    rv = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if 'lladdr' in parts and parts[-1] not in ('FAILED','INCOMPLETE'):
+            i = parts.index('lladdr')
+            if i + 1 < len(parts):
+                rv[parts[0]] = (parts[i+1].upper(), parts[-1] in NEIGH_PRESENT)
+    return rv
+
+def read_neighbors(arp_path='/proc/net/arp'):
+    '''
+    dict ip -> (mac, present) of the kernel neighbor table, from /proc/net/arp and
+    `ip neigh` when available, whose states are more precise
+    '''
+    rv = {}
+    try:
+        with open( arp_path, 'r' ) as fp:
+            rv.update( parse_proc_arp( fp.read() ) )
+    except OSError:
+        pass
+    try:
+        out = subprocess.run( ['ip', 'neigh'], capture_output=True, timeout=5 )
+        if out.returncode == 0:
+            rv.update( parse_ip_neigh( out.stdout.decode( 'utf-8', 'replace' ) ) )
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    return rv
+
+class Discovery:
+    '''
+    native replacement for nmap -sn: a host is up if a tcp connect to one of the ports
+    gets an answer, accepted or refused, or if its neighbor entry is confirmed after the
+    probes (REACHABLE, DELAY, PROBE or PERMANENT). The mac comes from the neighbor table,
+    stale entries included
+    '''
+    PORTS = (22, 80, 443, 445, 139, 53, 8080, 62078)
+
+    def __init__(self,concurrency=256,timeout=1.0,ports=PORTS,neighbors=read_neighbors):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.ports = ports
+        self.neighbors = neighbors
+
+    @staticmethod
+    def network_hosts(network):
+        net = ipaddress.ip_network( network, strict=False )
+        if net.num_addresses <= 2:
+            return [ str(x) for x in net ]
+        return [ str(x) for x in net.hosts() ]
+
+    async def probe_port(self,semaphore,ip,port):
+        import asyncio
+        async with semaphore:
+            try:
+                (reader,writer) = await asyncio.wait_for( asyncio.open_connection( ip, port ), self.timeout )
+            except ConnectionRefusedError:
+                return True
+            except (OSError, asyncio.TimeoutError):
+                return False
+            writer.close()
+            return True
+
+    async def probe_host(self,semaphore,ip):
+        '''
+        True as soon as one port answers, the other probes are then cancelled
+        '''
+        import asyncio
+        pending = { asyncio.ensure_future( self.probe_port( semaphore, ip, port ) ) for port in self.ports }
+        try:
+            while pending:
+                (done,pending) = await asyncio.wait( pending, return_when=asyncio.FIRST_COMPLETED )
+                if any( x.result() for x in done ):
+                    return True
+            return False
+        finally:
+            for x in pending:
+                x.cancel()
+
+    async def probe(self,hosts):
+        '''
+        set of the hosts up. A fixed pool of workers pulls the hosts, so only
+        concurrency hosts have tasks at any time, and the semaphore bounds the connects
+        '''
+        import asyncio
+        semaphore = asyncio.Semaphore( self.concurrency )
+        todo = iter( hosts )
+        up = set()
+
+        async def worker():
+            for ip in todo:
+                if await self.probe_host( semaphore, ip ):
+                    up.add( ip )
+
+        await asyncio.gather( *[ worker() for _ in range( max( 1, min( self.concurrency, len(hosts) ) ) ) ] )
+        return up
+
+    def discover(self,network):
+        '''
+        list of Device found up in network
+        '''
+        import asyncio
+        hosts = self.network_hosts( network )
+        up = asyncio.run( self.probe( hosts ) )
+        neighbors = self.neighbors()
+
+        now = datetime.datetime.now()
+        rv = []
+        for ip in hosts:
+            (mac,present) = neighbors.get( ip, (None,False) )
+            if present or ip in up:
+                info = { 'ipv4':ip, 'firstseen':now }
+                if mac:
+                    info['mac'] = mac
+                device = Device(info)
+                if mac:
+                    device.add_vendor()
+                rv.append( device )
+        return rv
+
+class ScanScheduler:
+    '''
+    scan a large network as shards of /prefix, with a bounded pool of workers.
+    Shards where devices were up or changed recently are rescanned every interval,
+    quiet ones QUIET_FACTOR times less often. The state of each shard is kept
+    in the cache dir between runs
+    '''
+    QUIET_FACTOR = 8
+    RECENT = 24 * 3600
+
+    def __init__(self,network,prefix,interval,state_path):
+        self.network = network
+        self.prefix = prefix
+        self.interval = interval
+        self.state_path = state_path
+        self.state = {}
+        try:
+            with open( state_path, 'r' ) as fp:
+                self.state = json.load( fp )
+        except (OSError, ValueError):
+            pass
+
+    def shards(self):
+        net = ipaddress.ip_network( self.network, strict=False )
+        if net.prefixlen >= self.prefix:
+            return [ str(net) ]
+        return [ str(x) for x in net.subnets( new_prefix=self.prefix ) ]
+
+    def is_active(self,shard,now):
+        info = self.state.get( shard, {} )
+        return info.get( 'up', 0 ) > 0 or now - info.get( 'changed', 0 ) < ScanScheduler.RECENT
+
+    def due_shards(self,now=None):
+        '''
+        shards due for a scan, the most recently changed and the busiest first
+        '''
+        now = now or time.time()
+        rv = []
+        for shard in self.shards():
+            info = self.state.get( shard, {} )
+            interval = self.interval if self.is_active( shard, now ) else self.interval * ScanScheduler.QUIET_FACTOR
+            if now - info.get( 'scanned', 0 ) >= interval:
+                rv.append( shard )
+        rv.sort( key=lambda x: (-self.state.get( x, {} ).get( 'changed', 0 ), -self.state.get( x, {} ).get( 'up', 0 ), self.state.get( x, {} ).get( 'scanned', 0 )) )
+        return rv
+
+    def record(self,shard,up,changed):
+        info = self.state.setdefault( shard, {} )
+        info['scanned'] = time.time()
+        info['up'] = up
+        if changed:
+            info['changed'] = info['scanned']
+
+    def save(self):
+        os.makedirs( os.path.dirname( self.state_path ), exist_ok=True )
+        tmp = '{}.{}'.format( self.state_path, os.getpid() )
+        with open( tmp, 'w' ) as fp:
+            json.dump( self.state, fp, indent=0, sort_keys=True )
+        os.replace( tmp, self.state_path )
+
+    def run(self,scan,devices,workers,on_merged=None,persist=True):
+        '''
+        scan the due shards with scan(shard) -> list of Device in a pool of workers,
+        each result is merged in devices as soon as its shard completes, then
+        on_merged(shard, found) is called. The state is only saved if persist,
+        a run whose results are not kept must not delay the next scans
+        '''
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        due = self.due_shards()
+        with ThreadPoolExecutor( max_workers=max( workers, 1 ) ) as executor:
+            futures = { executor.submit( scan, shard ):shard for shard in due }
+            for future in as_completed( futures ):
+                shard = futures[future]
+                found = future.result()
+                # devices without mac are not merged, they don't make a shard active
+                up = sum( 1 for x in found if x.mac() )
+                before = (devices.changed, devices.added)
+                devices.update_with( found, override=['ipv4'] )
+                changed = (devices.changed, devices.added) != before
+                self.record( shard, up, changed )
+                if persist:
+                    self.save()
+                print( 'SHARD {}: {} up, {} changed, {} added'.format( shard, up, devices.changed - before[0], devices.added - before[1] ) )
+                if on_merged:
+                    on_merged( shard, found )
+        return due
+
+class SightingLog:
+    '''
+    history of the devices seen by each scan, in a sqlite database.
+
+    A scan is a row (time, source), a device seen in consecutive scans of the same
+    source with the same ip is a single run (mac, source, first scan, last scan, ip)
+    so a device always online costs one row whatever the scan frequency. mac is the
+    48 bits int and ipv4 the 32 bits int. Scans older than DOWNSAMPLE_AFTER are
+    thinned to one per hour and source, everything older than RETENTION is deleted
+    '''
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS scans (id INTEGER PRIMARY KEY, time INTEGER NOT NULL, source INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS scans_source_time ON scans (source, time)',
+        'CREATE TABLE IF NOT EXISTS runs (mac INTEGER NOT NULL, source INTEGER NOT NULL, first_scan INTEGER NOT NULL, last_scan INTEGER NOT NULL, ip, PRIMARY KEY (mac, source, first_scan)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS runs_source_last ON runs (source, last_scan)',
+    ]
+    DOWNSAMPLE_AFTER = 7 * 24 * 3600
+    DOWNSAMPLE_PERIOD = 3600
+    RETENTION = 365 * 24 * 3600
+
+    def __init__(self,fname):
+        self.db = sqlite3.connect( fname )
+        with self.db:
+            for sql in SightingLog.SCHEMA:
+                self.db.execute( sql )
+
+    def source_id(self,name):
+        row = self.db.execute( 'SELECT id FROM sources WHERE name = ?', (name,) ).fetchone()
+        if row:
+            return row[0]
+        return self.db.execute( 'INSERT INTO sources (name) VALUES (?)', (name,) ).lastrowid
+
+    def record(self,devices,source,when=None):
+        '''
+        record the devices seen by one scan of source at when (epoch seconds, default now).
+        returns False if that scan was already recorded
+        '''
+        when = int( when if when is not None else time.time() )
+        with self.db:
+            source = self.source_id( source )
+            if self.db.execute( 'SELECT 1 FROM scans WHERE source = ? AND time = ?', (source,when) ).fetchone():
+                return False
+            previous = self.db.execute( 'SELECT MAX(id) FROM scans WHERE source = ?', (source,) ).fetchone()[0]
+            scan = self.db.execute( 'INSERT INTO scans (time, source) VALUES (?,?)', (when,source) ).lastrowid
+
+            # runs still open, ie that include the previous scan of this source
+            open_runs = { mac:(first,ip) for (mac,first,ip) in
+                          self.db.execute( 'SELECT mac, first_scan, ip FROM runs WHERE source = ? AND last_scan = ?', (source,previous) ) }
+            extended = []
+            started = {}
+            for device in devices:
+                mac = device.mac_int()
+                if mac < 0:
+                    continue
+                ip = device.ipv4_value()
+                run = open_runs.get( mac )
+                if run and run[1] == ip:
+                    extended.append( (scan,mac,source,run[0]) )
+                else:
+                    started[mac] = (mac,source,scan,scan,ip)
+            self.db.executemany( 'UPDATE runs SET last_scan = ? WHERE mac = ? AND source = ? AND first_scan = ?', extended )
+            self.db.executemany( 'INSERT INTO runs (mac, source, first_scan, last_scan, ip) VALUES (?,?,?,?,?)', started.values() )
+        return True
+
+    def compact(self,now=None):
+        '''
+        drop what is past retention, then downsample what is older than DOWNSAMPLE_AFTER:
+        runs of the same mac and ip less than DOWNSAMPLE_PERIOD apart are merged, and
+        only one scan per period is kept besides the first and last scan of each run.
+        A device seen at least once in a period of that age counts as online for the period
+        '''
+        now = int( now if now is not None else time.time() )
+        with self.db:
+            expired = self.db.execute( 'SELECT MAX(id) FROM scans WHERE time < ?', (now - SightingLog.RETENTION,) ).fetchone()[0]
+            if expired is not None:
+                self.db.execute( 'DELETE FROM runs WHERE last_scan <= ?', (expired,) )
+                # runs still going on start again at the oldest scan kept
+                self.db.execute( '''UPDATE runs SET first_scan = (SELECT MIN(id) FROM scans WHERE scans.source = runs.source AND scans.id > ?)
+                                    WHERE first_scan <= ?''', (expired,expired) )
+                self.db.execute( 'DELETE FROM scans WHERE id <= ?', (expired,) )
+
+            old = now - SightingLog.DOWNSAMPLE_AFTER
+            rows = self.db.execute( '''SELECT runs.mac, runs.source, runs.first_scan, runs.last_scan, runs.ip, f.time, l.time FROM runs
+                                       JOIN scans AS f ON f.id = runs.first_scan JOIN scans AS l ON l.id = runs.last_scan
+                                       WHERE l.time < ? ORDER BY runs.mac, runs.source, runs.first_scan''', (old,) )
+            merged = []
+            deleted = []
+            current = None
+            for (mac,source,first,last,ip,first_time,last_time) in rows:
+                if current and current[:2] == [mac,source] and current[4] == ip and first_time - current[6] < SightingLog.DOWNSAMPLE_PERIOD:
+                    deleted.append( (mac,source,first) )
+                    current[3] = last
+                    current[6] = last_time
+                    current[7] = True
+                else:
+                    if current and current[7]:
+                        merged.append( (current[3],current[0],current[1],current[2]) )
+                    current = [mac,source,first,last,ip,first_time,last_time,False]
+            if current and current[7]:
+                merged.append( (current[3],current[0],current[1],current[2]) )
+            self.db.executemany( 'DELETE FROM runs WHERE mac = ? AND source = ? AND first_scan = ?', deleted )
+            self.db.executemany( 'UPDATE runs SET last_scan = ? WHERE mac = ? AND source = ? AND first_scan = ?', merged )
+
+            self.db.execute( '''DELETE FROM scans WHERE time < ?
+                                AND id NOT IN (SELECT MIN(id) FROM scans WHERE time < ? GROUP BY source, time / ?)
+                                AND id NOT IN (SELECT first_scan FROM runs UNION SELECT last_scan FROM runs)''',
+                             (old, old, SightingLog.DOWNSAMPLE_PERIOD) )
+
+    def macs(self):
+        return [ x[0] for x in self.db.execute( 'SELECT DISTINCT mac FROM runs' ) ]
+
+    def last_seen(self,mac):
+        '''
+        datetime of the last scan that saw mac (48 bits int), None if never seen
+        '''
+        row = self.db.execute( 'SELECT MAX(scans.time) FROM runs JOIN scans ON scans.id = runs.last_scan WHERE runs.mac = ?', (mac,) ).fetchone()
+        return datetime.datetime.fromtimestamp( row[0] ) if row[0] is not None else None
+
+    def ip_history(self,mac):
+        '''
+        list of (first seen, last seen, ip) for each successive ip of mac
+        '''
+        rows = self.db.execute( '''SELECT f.time, l.time, runs.ip FROM runs
+                                   JOIN scans AS f ON f.id = runs.first_scan JOIN scans AS l ON l.id = runs.last_scan
+                                   WHERE runs.mac = ? ORDER BY f.time''', (mac,) )
+        rv = []
+        for (first,last,ip) in rows:
+            if rv and rv[-1][2] == ip:
+                rv[-1][1] = max( rv[-1][1], last )
+            else:
+                rv.append( [first,last,ip] )
+        return [ (datetime.datetime.fromtimestamp(first), datetime.datetime.fromtimestamp(last), decode_ipv4(ip)) for (first,last,ip) in rv ]
+
+    def online_ratio(self,mac,since,until=None):
+        '''
+        fraction of the scans between since and until (epoch seconds) that saw mac,
+        counting only the scans of sources that ever saw it. None if there was no such scan
+        '''
+        until = until if until is not None else time.time()
+        total = self.db.execute( '''SELECT COUNT(*) FROM scans WHERE time BETWEEN ? AND ?
+                                    AND source IN (SELECT DISTINCT source FROM runs WHERE mac = ?)''', (since,until,mac) ).fetchone()[0]
+        if not total:
+            return None
+        # the unary + keep sqlite on the id range of each run instead of the (source, time) index
+        seen = self.db.execute( '''SELECT COUNT(DISTINCT scans.id) FROM runs JOIN scans
+                                   ON +scans.source = runs.source AND scans.id BETWEEN runs.first_scan AND runs.last_scan
+                                   WHERE runs.mac = ? AND +scans.time BETWEEN ? AND ?''', (mac,since,until) ).fetchone()[0]
+        return seen / total
+
 class Command :
     def __init__(self,args):
         self.args = args
+        self.history = None
 
 
     def xml_file(self):
@@ -544,19 +1338,60 @@ class Command :
         return field
 
     
-    def nmap_get_list(self):
-        network = '192.168.1.0/24'
-        if self.args.network:
-            network = args.network
+    def live_devices(self):
+        '''
+        iterable of the Device currently up: scanned with the native engine
+        or read from the nmap xml, after running nmap if --run
+        '''
+        if self.args.run and self.args.engine == 'native':
+            discovery = Discovery( concurrency=self.args.concurrency, timeout=self.args.timeout )
+            return discovery.discover( self.args.network )
+
+        if self.args.run:
+            self.nmap_get_list()
+        return DeviceList.iter_nmap_xml_file(self.xml_file())
+
+    def nmap_get_list(self,network=None,xmlfile=None):
+        if network is None:
+            network = '192.168.1.0/24'
+            if self.args.network:
+                network = args.network
             
-        subprocess.call( ['sudo', 'nmap', '-sn', '-oX', self.xml_file(), network ] )
+        subprocess.call( ['sudo', 'nmap', '-sn', '-oX', xmlfile or self.xml_file(), network ] )
+
+    def scan_shard(self,shard):
+        '''
+        list of Device up in shard, with the engine selected
+        '''
+        if self.args.engine == 'native':
+            return Discovery( concurrency=self.args.concurrency, timeout=self.args.timeout ).discover( shard )
+
+        (fd,xmlfile) = tempfile.mkstemp( prefix='lancheck-', suffix='.xml' )
+        os.close( fd )
+        try:
+            self.nmap_get_list( shard, xmlfile )
+            return list( DeviceList.iter_nmap_xml_file( xmlfile ) )
+        except ET.ParseError:
+            return []
+        finally:
+            os.remove( xmlfile )
+
+    def scan_scheduler(self):
+        '''
+        ScanScheduler when --run on a network larger than a --shard, else None
+        '''
+        if not self.args.run or ipaddress.ip_network( self.args.network, strict=False ).prefixlen >= self.args.shard:
+            return None
+        key = '{}:{}'.format( os.path.abspath( self.args.json ), self.args.network )
+        state_path = os.path.join( cache_dir(), 'shards-{}.json'.format( hashlib.sha1( key.encode( 'utf-8' ) ).hexdigest()[:16] ) )
+        return ScanScheduler( self.args.network, self.args.shard, self.args.interval * 60, state_path )
 
 
     def nmap_get_names(self):
         subprocess.call( ['sudo', 'nmap', '-iL', self.args.targets, '-sU', '-p137,5353', '--script', 'nbstat,dns-service-discovery', '-oX', 'details.xml' ] )
         
     def cmd_show(self):
-        devices = DeviceList.from_json(args.json, all=args.all)
+        devices = DeviceList.load(args.json, all=args.all)
 
         if self.args.display == 'kismet':
             devices.display_kismet( 'UUID' )
@@ -580,14 +1415,11 @@ class Command :
 
 
     def cmd_live(self):
-
-        if self.args.run:
-            self.nmap_get_list()
-            
-            
-        devices = DeviceList.from_json(args.json,all=True)
+        devices = DeviceList.load(args.json,all=True)
         fields = devices.build_fields(self.args.args, ['ipv4','mac','name','vendor','location','hostname','model'])
-        live_devices = DeviceList.from_nmap_xml_file(self.xml_file())
+        live_devices = DeviceList(self.live_devices())
+        self.record_sightings( live_devices )
+        self.compact_sightings()
         live_devices.add_missing_fields(devices)
         live_devices.display_human(fields)
         live_devices.save_as_targets(self.args.targets)
@@ -595,7 +1427,7 @@ class Command :
         print( 'Found {} devices'.format(len(live_devices)) )
 
     def cmd_fields(self):
-        devices = DeviceList.from_json(args.json,all=args.all)
+        devices = DeviceList.load(args.json,all=args.all)
         fields = {}
         keylen = 0
         for device in devices.devices_list():
@@ -625,7 +1457,7 @@ class Command :
             print( 'Expecting a readable file to parse got {}'.format( args.args[0] if len(args.args) > 0 else 'no filename' ) )
             exit()
         
-        devices = DeviceList.from_json(args.json,all=True)
+        devices = DeviceList.load(args.json,all=True)
         re_mac = re.compile('([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}')
         re_ip  = re.compile('([0-9]{1,3}\.){3}[0-9]{1,3}')
 
@@ -656,15 +1488,97 @@ class Command :
                 unknown.display_human(fields=['mac','ipv4','vendor','lastlog'])
         
         
-    def cmd_update(self):
-        devices = DeviceList.from_json(args.json,all=True)
-        
+    def record_sightings(self,found,network=None):
+        '''
+        record found in the --history log, the source is the engine and network
+        scanned, or the xml file read
+        '''
+        if not self.args.history:
+            return
         if self.args.run:
-            self.nmap_get_list()
-            
-        found = DeviceList.from_nmap_xml_file(self.xml_file())
-        
-        devices.update_with( found, override=['ipv4'] )
+            source = '{} {}'.format( self.args.engine, network or self.args.network )
+            when = time.time()
+        else:
+            source = 'xml {}'.format( os.path.abspath( self.xml_file() ) )
+            when = os.path.getmtime( self.xml_file() )
+        self.sighting_log().record( found, source, when )
+
+    def sighting_log(self):
+        '''
+        SightingLog of --history, opened once per command
+        '''
+        if self.history is None and self.args.history:
+            self.history = SightingLog( self.args.history )
+        return self.history
+
+    def compact_sightings(self):
+        '''
+        compact the --history log once the command recorded everything
+        '''
+        if self.history:
+            self.history.compact()
+
+    def cmd_history(self):
+        if not self.args.history:
+            print( 'Expecting a --history database' )
+            exit()
+        history = self.sighting_log()
+        since = time.time() - self.args.window * 24 * 3600
+
+        if self.args.args:
+            devices = DeviceList.load(args.json,all=True) if os.path.isfile(args.json) else DeviceList([])
+            macs = []
+            for arg in self.args.args:
+                mac = encode_mac( arg.upper() )
+                if isinstance(mac, int):
+                    macs.append( mac )
+                else:
+                    macs += [ x.mac_int() for x in devices if arg in (x['ipv4'], x['name'], x['hostname']) ]
+        else:
+            macs = history.macs()
+
+        for mac in macs:
+            ratio = history.online_ratio( mac, since )
+            print( '{} last seen {} online {} over {} days'.format( decode_mac(mac), history.last_seen( mac ),
+                                                                    'n/a' if ratio is None else '{:.0%}'.format( ratio ), self.args.window ) )
+            if self.args.verbose:
+                for (first,last,ip) in history.ip_history( mac ):
+                    print( '  {} {} -> {}'.format( ip, first, last ) )
+
+    def cmd_import(self):
+        devices = DeviceList.load(args.json,all=True)
+        if not isinstance(devices, DeviceStore):
+            print( 'import expects a database for --json (.db or .sqlite), got {}'.format( args.json ) )
+            exit()
+        for fname in self.args.args:
+            print( 'Imported {} devices from {}'.format( devices.import_json(fname), fname ) )
+
+    def cmd_export(self):
+        if len( args.args ) < 1:
+            print( 'Expecting a json file to export to' )
+            exit()
+        devices = DeviceList.load(args.json,all=args.all)
+        devices.save_as_json(args.args[0])
+        print( 'Exported {} devices into {}'.format( len(devices), args.args[0] ) )
+
+    def cmd_update(self):
+        devices = DeviceList.load(args.json,all=True)
+
+        scheduler = self.scan_scheduler()
+        if scheduler:
+            def save_shard(shard,found):
+                self.record_sightings( found, shard )
+                if self.args.save and devices.has_changes():
+                    devices.save_as_json(self.args.json)
+            due = scheduler.run( self.scan_shard, devices, self.args.workers, save_shard, persist=self.args.save )
+            print( 'Scanned {} of {} shards'.format( len(due), len(scheduler.shards()) ) )
+        else:
+            found = self.live_devices()
+            if self.args.history:
+                found = list(found)
+                self.record_sightings( found )
+            devices.update_with( found, override=['ipv4'] )
+        self.compact_sightings()
         
         print( devices.status() )
 
@@ -679,7 +1593,10 @@ if __name__ == "__main__":
         'show': {'attr':'cmd_show','help':'show existing device from json file'},
         'update': {'attr':'cmd_update','help':'update json file from nmap or xml file' },
         'live':{'attr':'cmd_live','help':'show list host running nmap'},
-        'fields':{'attr':'cmd_fields','help':'show list of available fields in the json file' }
+        'fields':{'attr':'cmd_fields','help':'show list of available fields in the json file' },
+        'import':{'attr':'cmd_import','help':'import json files into the sqlite database given as --json' },
+        'export':{'attr':'cmd_export','help':'export the --json file or database to a json file' },
+        'history':{'attr':'cmd_history','help':'[MAC|IP|NAME...] last seen and online ratio from the --history log, -v for the ip history' }
     }
     
     description = "\n".join( [ '{}: {}'.format( k,v['help'] ) for (k,v) in commands.items() ] )
@@ -691,13 +1608,22 @@ if __name__ == "__main__":
     parser.add_argument( '-c', '--csv', metavar='CSVFILE', help='csv file to merge')
     parser.add_argument( '-d', '--display', help='display style human|kismet|wireshark|hosts|static_host_mapping', default='human' )
     parser.add_argument( '-f', '--force', action='store_true', help='Force save during update, helpful for reformatting file' )
-    parser.add_argument( '-j', '--json', metavar='JSONFILE', help='json file', default='network.json')
+    parser.add_argument( '-j', '--json', metavar='JSONFILE', help='json file, or sqlite database if it ends with .db or .sqlite', default='network.json')
     parser.add_argument( '-l', '--lan', metavar='LANFILE', help='lan file to merge')
     parser.add_argument( '-n', '--network', help='network definition for nmap', default='192.168.1.0/24')
     parser.add_argument( '-r', '--run', action='store_true', help='run nmap, else just use last cached file' )
+    parser.add_argument( '--engine', choices=['nmap','native'], help='scan with nmap or with the builtin tcp connect and neighbor table scan', default='nmap' )
+    parser.add_argument( '--concurrency', type=int, help='maximum connections in flight for the native engine', default=256 )
+    parser.add_argument( '--timeout', type=float, help='connect timeout in seconds for the native engine', default=1.0 )
+    parser.add_argument( '--shard', type=int, metavar='PREFIX', help='update --run scans networks larger than /PREFIX shard by shard', default=24 )
+    parser.add_argument( '--workers', type=int, help='number of shards scanned concurrently', default=4 )
+    parser.add_argument( '--interval', type=float, metavar='MINUTES', help='rescan interval of active shards, quiet ones are rescanned {} times less often'.format( ScanScheduler.QUIET_FACTOR ), default=60 )
     parser.add_argument( '-s', '--save', action='store_true', help='Save any update or change to the list' )
     parser.add_argument( '-t', '--targets', help='Target files either for read in list command or save in live command', default='targets.out' )
     parser.add_argument( '-x', '--xml', metavar='XMLFILE', help='xml file with nmap output' )
+    parser.add_argument( '--history', metavar='DBFILE', help='sqlite log where update and live record the devices seen' )
+    parser.add_argument( '--window', type=float, metavar='DAYS', help='window of the online ratio of history', default=7 )
+    parser.add_argument( '-v', '--verbose', action='store_true', help='verbose output' )
 
     args = parser.parse_args()
 
@@ -27,35 +27,1118 @@
 import sys
 import subprocess
 import os
-import distutils.spawn
 import hashlib
 import argparse
 import json
-from pprint import pprint
 import shutil
+import re
 import fnmatch
-import platform
+import bisect
+import functools
+import zlib
+import time
+import threading
+import collections
+import select
+import fcntl
+import struct
+import abc
+
+HASH_CHUNK_SIZE = 1024 * 1024
+_hash_buffer = threading.local()
+
+def file_hash(filepath,kind='sha256'):
+    '''
+    digest of the file content, streamed in chunks through a per-thread buffer
+    so memory stays flat whatever the size of the file
+
+    kind: sha256 of the content, or blob/blob256 for the id git gives
+          to the file in a sha1 or sha256 repository
+    '''
+    if not hasattr( _hash_buffer, 'view' ):
+        _hash_buffer.view = memoryview( bytearray( HASH_CHUNK_SIZE ) )
+    view = _hash_buffer.view
+
+    with open(filepath, 'rb', buffering=0) as openedFile:
+        if kind == 'sha256':
+            hash = hashlib.sha256()
+        else:
+            hash = hashlib.sha256() if kind == 'blob256' else hashlib.sha1()
+            hash.update( b'blob %d\0' % os.fstat( openedFile.fileno() ).st_size )
+        size = openedFile.readinto( view )
+        while size:
+            hash.update( view[:size] )
+            size = openedFile.readinto( view )
+    return hash.hexdigest()
 
-def file_hash(filepath):
-    openedFile = open(filepath, 'rb')
-    readFile = openedFile.read()
+# ioctl to share the extents of a file on btrfs, xfs and other CoW filesystems
+FICLONE = 0x40049409
+
+def copy_file_data(from_fd,to_fd,size):
+    '''
+    copy size bytes from from_fd to to_fd, cheapest method first:
+    reflink, copy_file_range, sendfile then a buffered copy
+
+    returns the name of the method that worked
+    '''
+    try:
+        fcntl.ioctl( to_fd, FICLONE, from_fd )
+        return 'reflink'
+    except OSError:
+        pass
+
+    for (method,copy) in [ ('copy_file_range', getattr( os, 'copy_file_range', None ) ),
+                           ('sendfile', lambda i,o,n: os.sendfile( o, i, None, n ) ) ]:
+        if copy is None:
+            continue
+        try:
+            copied = 0
+            while copied < size:
+                done = copy( from_fd, to_fd, size - copied )
+                if done == 0:
+                    break
+                copied += done
+            if copied == size:
+                return method
+        except OSError:
+            pass
+        # start again from scratch with the next method
+        os.lseek( from_fd, 0, os.SEEK_SET )
+        os.lseek( to_fd, 0, os.SEEK_SET )
+        os.ftruncate( to_fd, 0 )
+
+    with os.fdopen( from_fd, 'rb', closefd=False ) as from_file, os.fdopen( to_fd, 'wb', closefd=False ) as to_file:
+        shutil.copyfileobj( from_file, to_file, HASH_CHUNK_SIZE )
+    return 'buffered'
+
+def stage_file(from_path,to_path,tmp_path):
+    '''
+    copy from_path into tmp_path, a temporary file next to to_path ready to be
+    renamed over it. The content gets the mtime of from_path, it keeps the mode
+    and owner of to_path if it exists, else the mode of from_path
+
+    returns the name of the method used to copy the data
+    '''
+    to_dir = os.path.dirname( to_path )
+    os.makedirs( to_dir, exist_ok=True )
+    from_stat = os.stat( from_path )
+    try:
+        to_stat = os.stat( to_path )
+    except FileNotFoundError:
+        to_stat = None
+
+    from_fd = os.open( from_path, os.O_RDONLY )
+    try:
+        to_fd = os.open( tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600 )
+        try:
+            method = copy_file_data( from_fd, to_fd, from_stat.st_size )
+            if to_stat:
+                try:
+                    os.fchown( to_fd, to_stat.st_uid, to_stat.st_gid )
+                except PermissionError:
+                    pass
+            os.fchmod( to_fd, (to_stat or from_stat).st_mode & 0o7777 )
+        finally:
+            os.close( to_fd )
+        os.utime( tmp_path, ns=( from_stat.st_atime_ns, from_stat.st_mtime_ns ) )
+    except BaseException:
+        if os.path.exists( tmp_path ):
+            os.unlink( tmp_path )
+        raise
+    finally:
+        os.close( from_fd )
+    return method
+
+def staging_path(to_path):
+    return os.path.join( os.path.dirname( to_path ), '.{}.syncfiles-{}'.format( os.path.basename( to_path ), os.getpid() ) )
+
+def replace_file(tmp_path,to_path):
+    '''
+    move tmp_path over to_path. A target with other hard links is rewritten in
+    place instead, so all the links see the new content, but not atomically.
+    to_path should already be resolved with os.path.realpath so symlinks are kept
+    '''
+    try:
+        linked = os.stat( to_path ).st_nlink > 1
+    except FileNotFoundError:
+        linked = False
+    if not linked:
+        os.replace( tmp_path, to_path )
+        return
+
+    tmp_stat = os.stat( tmp_path )
+    from_fd = os.open( tmp_path, os.O_RDONLY )
+    try:
+        to_fd = os.open( to_path, os.O_WRONLY | os.O_TRUNC )
+        try:
+            copy_file_data( from_fd, to_fd, tmp_stat.st_size )
+            os.fchmod( to_fd, tmp_stat.st_mode & 0o7777 )
+            os.fsync( to_fd )
+        finally:
+            os.close( to_fd )
+    finally:
+        os.close( from_fd )
+    os.utime( to_path, ns=( tmp_stat.st_atime_ns, tmp_stat.st_mtime_ns ) )
+    os.unlink( tmp_path )
+
+def fsync_path(path,flags=os.O_RDONLY):
+    fd = os.open( path, flags )
+    try:
+        os.fsync( fd )
+    finally:
+        os.close( fd )
+
+class ApplyJournal :
+    STAGING = 'staging'
+    COMMITTING = 'committing'
+
+    def __init__(self,path,verbose=False):
+        '''
+        ApplyJournal Object:
 
-    hash = hashlib.sha1(readFile)
-    return hash.hexdigest()
+        path: json file describing the batch of copies being applied
+
+        Copies are staged in temporary files next to their target, fsync'ed
+        together, then renamed into place. If a run is interrupted, the next one
+        rolls the batch forward if every file was staged, or back otherwise.
+        Symlinked targets are resolved so the file they point to is updated
+        '''
+        self.path = path
+        self.verbose = verbose
+        self.copies = []
+
+    def __repr__(self):
+        return 'ApplyJournal: %s (%d copies)' %( self.path, len(self.copies) )
+
+    def add(self,from_path,to_path):
+        self.copies.append( (from_path,to_path) )
+
+    def write(self,state,entries):
+        os.makedirs( os.path.dirname( self.path ), exist_ok=True )
+        tmp_path = '{}.{}'.format( self.path, os.getpid() )
+        with open( tmp_path, 'w' ) as journal_file:
+            json.dump( {'state':state,'entries':entries}, journal_file )
+            journal_file.flush()
+            os.fsync( journal_file.fileno() )
+        os.replace( tmp_path, self.path )
+        fsync_path( os.path.dirname( self.path ) )
+
+    def apply(self):
+        if not self.copies:
+            return
+        targets = [ os.path.realpath( to_path ) for (from_path,to_path) in self.copies ]
+        entries = [ [ staging_path( to_path ), to_path ] for to_path in targets ]
+        start = time.perf_counter()
+        self.write( ApplyJournal.STAGING, entries )
+        try:
+            for ((from_path,_),(tmp_path,to_path)) in zip( self.copies, entries ):
+                method = stage_file( from_path, to_path, tmp_path )
+                if self.verbose:
+                    print( 'STAGE: {} with {}'.format( to_path, method ) )
+            staged = time.perf_counter()
+            for (tmp_path,to_path) in entries:
+                fsync_path( tmp_path )
+        except BaseException:
+            self.rollback( entries )
+            raise
+        synced = time.perf_counter()
+
+        self.write( ApplyJournal.COMMITTING, entries )
+        self.commit( entries )
+        if self.verbose:
+            print( 'APPLY: {} files, staged in {:.3f}s, fsync in {:.3f}s, renamed in {:.3f}s'.format(
+                len(entries), staged - start, synced - staged, time.perf_counter() - synced ) )
+        self.copies = []
+
+    def commit(self,entries):
+        dirs = set()
+        for (tmp_path,to_path) in entries:
+            if os.path.exists( tmp_path ):
+                replace_file( tmp_path, to_path )
+                dirs.add( os.path.dirname( to_path ) )
+        for dir in dirs:
+            fsync_path( dir )
+        os.unlink( self.path )
+
+    def rollback(self,entries):
+        for (tmp_path,to_path) in entries:
+            if os.path.exists( tmp_path ):
+                os.unlink( tmp_path )
+        if os.path.exists( self.path ):
+            os.unlink( self.path )
+
+    def recover(self):
+        '''
+        finish or undo a batch left by an interrupted run
+        '''
+        try:
+            with open( self.path, 'r' ) as journal_file:
+                data = json.load( journal_file )
+        except FileNotFoundError:
+            return
+        except ValueError:
+            data = {'state':None,'entries':[]}
+
+        if data['state'] == ApplyJournal.COMMITTING:
+            self.commit( data['entries'] )
+            print( 'JOURNAL: completed {} copies from an interrupted run'.format( len(data['entries']) ) )
+        else:
+            self.rollback( data['entries'] )
+            print( 'JOURNAL: discarded {} copies staged by an interrupted run'.format( len(data['entries']) ) )
+
+def thread_pool(max_workers):
+    '''
+    concurrent.futures is only imported by the commands that actually use threads
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor( max_workers=max_workers )
+
+def read_lines(filepath):
+    '''
+    lines of a text file with their line ending, None if the file looks binary
+    '''
+    with open( filepath, 'rb' ) as text_file:
+        data = text_file.read()
+    if b'\0' in data[:8192]:
+        return None
+    # only split on \n, str.splitlines would also break on \r and other separators
+    lines = data.decode( 'utf-8', errors='replace' ).split( '\n' )
+    rv = [ x + '\n' for x in lines[:-1] ]
+    if lines[-1]:
+        rv.append( lines[-1] )
+    return rv
+
+def data_dir():
+    base = os.environ.get( 'XDG_DATA_HOME', os.path.expanduser( '~/.local/share' ) )
+    return os.path.join( base, 'syncfiles' )
+
+def cache_dir():
+    base = os.environ.get( 'XDG_CACHE_HOME', os.path.expanduser( '~/.cache' ) )
+    return os.path.join( base, 'syncfiles' )
+
+class HashCache :
+    version = 2
+
+    def __init__(self,path,rehash=False,verbose=False):
+        '''
+        HashCache Object:
+
+        path: json file where the digests are persisted
+        rehash: ignore existing entries and recompute every digest
+
+        entries are keyed by absolute path and store [size, mtime_ns, inode, {kind:digest}],
+        a file whose stat still matches is never read again
+        '''
+        self.path = path
+        self.rehash = rehash
+        self.verbose = verbose
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def __repr__(self):
+        return 'HashCache: %s (%d entries)' %( self.path, len(self.entries) )
+
+    def load(self):
+        try:
+            with open( self.path, 'r' ) as cache_file:
+                data = json.load( cache_file )
+            if data.get( 'version' ) == HashCache.version:
+                self.entries = data['entries']
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs( os.path.dirname( self.path ), exist_ok=True )
+        tmp_path = '{}.{}'.format( self.path, os.getpid() )
+        with open( tmp_path, 'w' ) as cache_file:
+            json.dump( {'version':HashCache.version,'entries':self.entries}, cache_file )
+        os.replace( tmp_path, self.path )
+        self.dirty = False
+        if self.verbose:
+            print( 'CACHE: saved {} entries, {} hits, {} misses'.format( len(self.entries), self.hits, self.misses ) )
+
+    @staticmethod
+    def stat_key(st):
+        return [ st.st_size, st.st_mtime_ns, st.st_ino ]
+
+    def file_hash(self,filepath,st=None,kind='sha256'):
+        filepath = os.path.abspath( filepath )
+        if st is None:
+            st = os.stat( filepath )
+
+        digest = self.cached_hash( filepath, st, kind )
+        if digest:
+            self.hits += 1
+            return digest
+
+        self.misses += 1
+        digest = file_hash( filepath, kind )
+        self.remember( filepath, st, kind, digest )
+        return digest
+
+    def cached_hash(self,filepath,st,kind='sha256'):
+        '''
+        digest of filepath if known for its current stat, None otherwise
+        '''
+        entry = self.entries.get( os.path.abspath( filepath ) )
+        if entry and not self.rehash and entry[:3] == HashCache.stat_key( st ):
+            return entry[3].get( kind )
+        return None
+
+    @staticmethod
+    def is_racy(st):
+        '''
+        like git, a stat that could still change within the mtime granularity is not trusted
+        '''
+        return st.st_mtime_ns >= time.time_ns() - 2000000000
+
+    def remember(self,filepath,st,kind,digest):
+        if HashCache.is_racy( st ):
+            return
+        filepath = os.path.abspath( filepath )
+        key = HashCache.stat_key( st )
+        entry = self.entries.get( filepath )
+        if entry is None or entry[:3] != key:
+            entry = key + [ {} ]
+            self.entries[filepath] = entry
+        entry[3][kind] = digest
+        self.dirty = True
+
+    def prune(self):
+        '''
+        remove entries for files that no longer exist or whose stat changed
+        '''
+        removed = 0
+        for filepath in list(self.entries.keys()):
+            try:
+                keep = self.entries[filepath][:3] == HashCache.stat_key( os.stat( filepath ) )
+            except OSError:
+                keep = False
+            if not keep:
+                del self.entries[filepath]
+                removed += 1
+        if removed:
+            self.dirty = True
+        return removed
+
+    def clear(self):
+        self.entries = {}
+        self.dirty = True
+
+
+def gitignore_regex(pattern):
+    '''
+    translate one gitignore pattern, without its leading ! or trailing /,
+    into a regex matching paths relative to the base directory
+    '''
+    # a slash anywhere but at the end anchors the pattern to the base directory
+    anchored = '/' in pattern
+    if pattern.startswith('/'):
+        pattern = pattern[1:]
+
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern.startswith( '**', i ) and (i == 0 or pattern[i-1] == '/') and (i+2 == n or pattern[i+2] == '/'):
+                if i+2 == n:
+                    # trailing /** matches everything inside
+                    out.append( '.*' )
+                else:
+                    # leading **/ or a/**/b matches zero or more directories
+                    out.append( '(?:.*/)?' )
+                    i += 1
+                i += 2
+                continue
+            out.append( '[^/]*' )
+        elif c == '?':
+            out.append( '[^/]' )
+        elif c == '[':
+            j = pattern.find( ']', i+2 )
+            if j == -1:
+                out.append( '\\[' )
+            else:
+                chars = pattern[i+1:j].replace( '\\', '\\\\' )
+                if chars.startswith( '!' ):
+                    chars = '^' + chars[1:]
+                out.append( '[{}]'.format( chars ) )
+                i = j
+        elif c == '\\' and i+1 < n:
+            i += 1
+            out.append( re.escape( pattern[i] ) )
+        else:
+            out.append( re.escape( c ) )
+        i += 1
+
+    rv = ''.join( out )
+    if not anchored:
+        rv = '(?:.*/)?' + rv
+    return rv
+
+class Manifest :
+    version = 1
+
+    UNCHANGED = 'unchanged'
+    SRC = 'src'
+    DIR = 'dir'
+    BOTH = 'both'
+
+    def __init__(self,path,verbose=False):
+        '''
+        Manifest Object:
+
+        path: json file where the state of the last sync is persisted
+
+        entries are keyed by the file in the repo and store the last agreed
+        digest with the stat [size, mtime_ns, inode] of both sides at the time,
+        so a pair can be classified from its stats only. An entry recorded while
+        a stat was racy (see HashCache.is_racy) is flagged so the pair is still
+        compared until it is recorded again
+        '''
+        self.path = path
+        self.verbose = verbose
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def __repr__(self):
+        return 'Manifest: %s (%d entries)' %( self.path, len(self.entries) )
+
+    def load(self):
+        try:
+            with open( self.path, 'r' ) as manifest_file:
+                data = json.load( manifest_file )
+            if data.get( 'version' ) == Manifest.version:
+                self.entries = data['entries']
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs( os.path.dirname( self.path ), exist_ok=True )
+        tmp_path = '{}.{}'.format( self.path, os.getpid() )
+        with open( tmp_path, 'w' ) as manifest_file:
+            json.dump( {'version':Manifest.version,'entries':self.entries}, manifest_file )
+        os.replace( tmp_path, self.path )
+        self.dirty = False
+        if self.verbose:
+            print( 'MANIFEST: saved {} entries'.format( len(self.entries) ) )
+
+    def classify(self,filepair):
+        '''
+        UNCHANGED, SRC, DIR or BOTH depending on which side changed since the last sync
+        or None if the pair was never recorded
+        '''
+        entry = self.entries.get( os.path.abspath( filepair.dir_file() ) )
+        if entry is None or entry['src_file'] != filepair.src_file():
+            return None
+        try:
+            dir_changed = entry['dir'] != HashCache.stat_key( os.stat( filepair.dir_file() ) )
+            src_changed = entry['src'] != HashCache.stat_key( os.stat( filepair.src_file() ) )
+        except OSError:
+            return None
+
+        if dir_changed and src_changed:
+            return Manifest.BOTH
+        elif dir_changed:
+            return Manifest.DIR
+        elif src_changed:
+            return Manifest.SRC
+        return Manifest.UNCHANGED
+
+    def is_racy(self,filepair):
+        entry = self.entries.get( os.path.abspath( filepair.dir_file() ) )
+        return entry is None or entry.get( 'racy', False )
+
+    def record(self,filepair,digest):
+        dir_stat = os.stat( filepair.dir_file() )
+        src_stat = os.stat( filepair.src_file() )
+        self.entries[os.path.abspath( filepair.dir_file() )] = {
+            'src_file':filepair.src_file(),
+            'digest':digest,
+            'dir':HashCache.stat_key( dir_stat ),
+            'src':HashCache.stat_key( src_stat ),
+            'racy':HashCache.is_racy( dir_stat ) or HashCache.is_racy( src_stat )
+        }
+        self.dirty = True
+
+class SnapshotStore :
+    def __init__(self,path):
+        '''
+        SnapshotStore Object:
+
+        path: directory of the store. objects/ keeps the zlib compressed content
+        of the files named by their sha256, so identical content is stored once,
+        and snapshots.jsonl logs one line per file saved, with the time of the batch
+        '''
+        self.path = path
+        self.objects = os.path.join( path, 'objects' )
+        self.log_path = os.path.join( path, 'snapshots.jsonl' )
+        self.begin_batch()
+
+    def __repr__(self):
+        return 'SnapshotStore: %s' %( self.path, )
+
+    def begin_batch(self):
+        '''
+        the snapshots taken from now on are logged with the current time,
+        a long running command like watch starts a batch for each set of copies
+        '''
+        self.timestamp = time.strftime( '%Y-%m-%dT%H:%M:%S' )
+
+    def object_path(self,digest):
+        return os.path.join( self.objects, digest[:2], digest[2:] )
+
+    def store(self,filepath):
+        '''
+        compress filepath into the store while hashing it, so it is read only once
+        returns its sha256
+        '''
+        os.makedirs( self.objects, exist_ok=True )
+        tmp_path = os.path.join( self.objects, 'tmp-{}-{}'.format( os.getpid(), threading.get_ident() ) )
+        hash = hashlib.sha256()
+        compressor = zlib.compressobj()
+        with open( filepath, 'rb' ) as from_file, open( tmp_path, 'wb' ) as object_file:
+            chunk = from_file.read( HASH_CHUNK_SIZE )
+            while chunk:
+                hash.update( chunk )
+                object_file.write( compressor.compress( chunk ) )
+                chunk = from_file.read( HASH_CHUNK_SIZE )
+            object_file.write( compressor.flush() )
+
+        digest = hash.hexdigest()
+        object_path = self.object_path( digest )
+        if os.path.exists( object_path ):
+            os.unlink( tmp_path )
+        else:
+            os.makedirs( os.path.dirname( object_path ), exist_ok=True )
+            os.replace( tmp_path, object_path )
+        return digest
+
+    def snapshot(self,filepath,st,digest=None):
+        '''
+        save the current content of filepath whose stat is st, digest is its
+        sha256 if already known, in which case content already in the store
+        is not read again. Returns the sha256
+        '''
+        if digest is None or not os.path.exists( self.object_path( digest ) ):
+            digest = self.store( filepath )
+        entry = {'time':self.timestamp,'path':os.path.abspath( filepath ),'sha256':digest,
+                 'size':st.st_size,'mode':st.st_mode & 0o7777,'mtime_ns':st.st_mtime_ns}
+        with open( self.log_path, 'a' ) as log_file:
+            log_file.write( json.dumps( entry ) + '\n' )
+        return digest
+
+    def entries(self):
+        rv = []
+        try:
+            with open( self.log_path, 'r' ) as log_file:
+                for line in log_file:
+                    rv.append( json.loads( line ) )
+        except FileNotFoundError:
+            pass
+        return rv
+
+    def restore(self,entry):
+        '''
+        write back the content of a snapshot entry atomically, with its mode and mtime
+        '''
+        to_path = os.path.realpath( entry['path'] )
+        os.makedirs( os.path.dirname( to_path ), exist_ok=True )
+        tmp_path = staging_path( to_path )
+        decompressor = zlib.decompressobj()
+        try:
+            with open( self.object_path( entry['sha256'] ), 'rb' ) as object_file, open( tmp_path, 'wb' ) as to_file:
+                chunk = object_file.read( HASH_CHUNK_SIZE )
+                while chunk:
+                    to_file.write( decompressor.decompress( chunk ) )
+                    chunk = object_file.read( HASH_CHUNK_SIZE )
+                to_file.write( decompressor.flush() )
+                os.fchmod( to_file.fileno(), entry['mode'] )
+            os.utime( tmp_path, ns=( entry['mtime_ns'], entry['mtime_ns'] ) )
+            replace_file( tmp_path, to_path )
+        except BaseException:
+            if os.path.exists( tmp_path ):
+                os.unlink( tmp_path )
+            raise
+
+class IgnoreMatcher :
+    def __init__(self,rules):
+        '''
+        IgnoreMatcher Object:
+
+        rules: list of gitignore style rules (anchoring, *, **, [], !negation, dir/ only)
+               matched against paths relative to the base directory.
+
+        Rules are compiled once: literal rules go in dicts, rules without a slash
+        are matched on the file name only and the others on the relative path,
+        each group of patterns in a single regex. Alternatives are in reverse
+        order so the first one found is the last rule matching, as in gitignore
+        '''
+        self.negated = []
+        self.file_rules = IgnoreMatcher.Rules()
+        self.dir_rules = IgnoreMatcher.Rules()
+        for rule in rules:
+            rule = rule.rstrip()
+            if not rule or rule.startswith( '#' ):
+                continue
+            negate = rule.startswith( '!' )
+            if negate or rule.startswith( '\\!' ) or rule.startswith( '\\#' ):
+                rule = rule[1:]
+            dir_only = rule.endswith( '/' )
+            rule = rule.rstrip( '/' )
+            if not rule:
+                continue
 
+            index = len(self.negated)
+            self.negated.append( negate )
+            self.dir_rules.add( index, rule )
+            if not dir_only:
+                self.file_rules.add( index, rule )
+
+        self.file_rules.compile()
+        self.dir_rules.compile()
+        self.dir_cache = {}
+
+    class Rules :
+        def __init__(self):
+            self.names = {}
+            self.paths = {}
+            self.name_patterns = []
+            self.path_patterns = []
+
+        def add(self,index,rule):
+            anchored = '/' in rule
+            if not any( c in rule for c in '*?[\\' ):
+                if anchored:
+                    self.paths[rule.lstrip('/')] = index
+                else:
+                    self.names[rule] = index
+            elif anchored:
+                self.path_patterns.append( '(?P<r{}>{})'.format( index, gitignore_regex( rule ) ) )
+            else:
+                # unanchored rule only ever match the last component
+                self.name_patterns.append( '(?P<r{}>{})'.format( index, gitignore_regex( '/' + rule ) ) )
+
+        def compile(self):
+            self.name_regex = re.compile( '|'.join( reversed( self.name_patterns ) ) ) if self.name_patterns else None
+            self.path_regex = re.compile( '|'.join( reversed( self.path_patterns ) ) ) if self.path_patterns else None
+
+        def last_rule(self,rel_path):
+            name = rel_path[rel_path.rfind('/')+1:]
+            rv = max( self.names.get( name, -1 ), self.paths.get( rel_path, -1 ) )
+            if self.name_regex:
+                found = self.name_regex.fullmatch( name )
+                if found:
+                    rv = max( rv, int( found.lastgroup[1:] ) )
+            if self.path_regex:
+                found = self.path_regex.fullmatch( rel_path )
+                if found:
+                    rv = max( rv, int( found.lastgroup[1:] ) )
+            return rv
+
+    def match(self,rel_path,is_dir=False):
+        '''
+        True if rel_path should be ignored, which is always the case if one
+        of its parent directory is ignored
+        '''
+        if is_dir:
+            rv = self.dir_cache.get( rel_path )
+            if rv is not None:
+                return rv
+
+        slash = rel_path.rfind( '/' )
+        rv = slash > 0 and self.match( rel_path[:slash], True )
+        if not rv:
+            index = (self.dir_rules if is_dir else self.file_rules).last_rule( rel_path )
+            rv = index >= 0 and not self.negated[index]
+
+        if is_dir:
+            self.dir_cache[rel_path] = rv
+        return rv
+
+@functools.lru_cache( maxsize=None )
+def compile_ignore(rules):
+    return IgnoreMatcher( rules )
+
+class Predicate :
+    '''
+    validate expressions, ex: "os:linux and (hostname:web* or env:DEPLOY=prod) and not path-exists:~/.nosync"
+
+    terms are hostname:GLOB, os:GLOB (Linux, Darwin), platform:GLOB (linux, darwin),
+    env:NAME or env:NAME=GLOB and path-exists:PATH, combined with and, or, not and
+    parenthesis. Globs are case insensitive and values can be quoted
+    '''
+    TOKEN = re.compile( r'''\s*(?:(\(|\))|([a-z][a-z-]*):("[^"]*"|'[^']*'|[^\s()]+)|([^\s()]+))''' )
+    KEYS = ( 'hostname', 'os', 'platform', 'env', 'path-exists' )
+
+    def __init__(self,text):
+        self.text = text
+        self.tokens = []
+        for m in self.TOKEN.finditer( text.strip() ):
+            (paren,key,value,word) = m.groups()
+            if key:
+                if key not in self.KEYS:
+                    raise ValueError( 'unknown term "{}", use one of {}'.format( key, ', '.join( self.KEYS ) ) )
+                if value[0] in '"\'':
+                    value = value[1:-1]
+                self.tokens.append( (key,value) )
+            elif word and word not in ('and','or','not','true','false'):
+                raise ValueError( 'unexpected "{}"'.format( word ) )
+            else:
+                self.tokens.append( paren or word )
+        self.position = 0
+        self.tree = self.parse_or()
+        if self.position < len(self.tokens):
+            raise ValueError( 'unexpected "{}"'.format( self.tokens[self.position] ) )
+        del self.tokens
+
+    def next_is(self,token):
+        if self.position < len(self.tokens) and self.tokens[self.position] == token:
+            self.position += 1
+            return True
+        return False
+
+    def parse_or(self):
+        rv = self.parse_and()
+        while self.next_is( 'or' ):
+            rv = ('or', rv, self.parse_and())
+        return rv
+
+    def parse_and(self):
+        rv = self.parse_not()
+        while self.next_is( 'and' ):
+            rv = ('and', rv, self.parse_not())
+        return rv
+
+    def parse_not(self):
+        if self.next_is( 'not' ):
+            return ('not', self.parse_not())
+        if self.next_is( '(' ):
+            rv = self.parse_or()
+            if not self.next_is( ')' ):
+                raise ValueError( 'missing ")"' )
+            return rv
+        if self.position >= len(self.tokens):
+            raise ValueError( 'unexpected end' )
+        token = self.tokens[self.position]
+        self.position += 1
+        if token in ('true','false'):
+            return ('const', token == 'true')
+        if isinstance( token, tuple ):
+            return ('term',) + token
+        raise ValueError( 'unexpected "{}"'.format( token ) )
+
+    def evaluate(self,facts):
+        return self.evaluate_node( self.tree, facts )
+
+    def evaluate_node(self,node,facts):
+        op = node[0]
+        if op == 'and':
+            return self.evaluate_node( node[1], facts ) and self.evaluate_node( node[2], facts )
+        if op == 'or':
+            return self.evaluate_node( node[1], facts ) or self.evaluate_node( node[2], facts )
+        if op == 'not':
+            return not self.evaluate_node( node[1], facts )
+        if op == 'const':
+            return node[1]
+        return facts.term( node[1], node[2] )
+
+class HostFacts :
+    '''
+    what a Predicate is evaluated against, each term is only evaluated once
+    '''
+    def __init__(self,hostname=None,system=None,sys_platform=None,environ=None):
+        uname = os.uname()
+        self.hostname = hostname if hostname is not None else uname.nodename
+        self.system = system if system is not None else uname.sysname
+        self.platform = sys_platform if sys_platform is not None else sys.platform
+        self.environ = environ if environ is not None else os.environ
+        self.terms = {}
+
+    def term(self,key,value):
+        rv = self.terms.get( (key,value) )
+        if rv is None:
+            rv = self.compute_term( key, value )
+            self.terms[(key,value)] = rv
+        return rv
+
+    def compute_term(self,key,value):
+        if key == 'hostname':
+            return fnmatch.fnmatch( self.hostname.lower(), value.lower() ) or fnmatch.fnmatch( self.hostname.split( '.' )[0].lower(), value.lower() )
+        if key == 'os':
+            return fnmatch.fnmatch( self.system.lower(), value.lower() )
+        if key == 'platform':
+            return fnmatch.fnmatch( self.platform.lower(), value.lower() )
+        if key == 'env':
+            (name,equal,pattern) = value.partition( '=' )
+            if not equal:
+                return bool( self.environ.get( name ) )
+            return fnmatch.fnmatchcase( self.environ.get( name, '' ), pattern )
+        return os.path.exists( os.path.expanduser( value ) )
+
+@functools.lru_cache( maxsize=None )
+def compile_predicate(text):
+    return Predicate( text )
+
+class PrefixIndex :
+    def __init__(self,paths):
+        '''
+        PrefixIndex Object:
+
+        paths: directories to search, kept sorted so the lookup is a bisect
+        '''
+        self.keys = sorted(paths)
+
+    def longest_prefix(self,path):
+        '''
+        longest key that is path itself or one of its parent directory, or None
+        '''
+        query = path
+        while query:
+            i = bisect.bisect_right( self.keys, query )
+            if i == 0:
+                return None
+            key = self.keys[i-1]
+            if path == key or path.startswith( key + '/' ):
+                return key
+            # any parent of path in keys is also a prefix of key, search again below both
+            query = os.path.commonprefix( [ key, query ] )
+            if query == key:
+                query = query[:-1]
+        return None
+
+class InotifyWatcher :
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_CLOEXEC = 0o2000000
+
+    EVENT_HEADER = struct.Struct( 'iIII' )
+
+    def __init__(self,dirs):
+        '''
+        InotifyWatcher Object:
+
+        dirs: directories to watch (not recursive), through a ctypes binding of libc inotify
+        raise OSError if inotify is not available
+        '''
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL( ctypes.util.find_library( 'c' ) or 'libc.so.6', use_errno=True )
+        if not hasattr( libc, 'inotify_init1' ):
+            raise OSError( 'inotify not available' )
+        self.fd = libc.inotify_init1( InotifyWatcher.IN_CLOEXEC )
+        if self.fd < 0:
+            raise OSError( ctypes.get_errno(), 'inotify_init1 failed' )
+
+        self.libc = libc
+        self.watches = {}
+        self.add( dirs )
+
+    def add(self,dirs):
+        '''
+        start watching dirs, returns the ones that were not watched yet
+        '''
+        mask = InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_MOVED_TO | InotifyWatcher.IN_CREATE | InotifyWatcher.IN_DELETE | InotifyWatcher.IN_ATTRIB
+        watched = set( self.watches.values() )
+        rv = set()
+        for dir in dirs:
+            if dir in watched:
+                continue
+            wd = self.libc.inotify_add_watch( self.fd, os.fsencode( dir ), mask )
+            if wd >= 0:
+                self.watches[wd] = dir
+                rv.add( dir )
+        return rv
+
+    def __repr__(self):
+        return 'InotifyWatcher: %d directories' %( len(self.watches), )
+
+    def wait(self,timeout=None):
+        '''
+        set of paths changed, waiting at most timeout seconds or forever if None
+        '''
+        (ready,_,_) = select.select( [self.fd], [], [], timeout )
+        if not ready:
+            return set()
+
+        rv = set()
+        data = os.read( self.fd, 65536 )
+        offset = 0
+        while offset < len(data):
+            (wd,mask,cookie,length) = InotifyWatcher.EVENT_HEADER.unpack_from( data, offset )
+            offset += InotifyWatcher.EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip( b'\0' )
+            offset += length
+            if wd in self.watches and name:
+                rv.add( os.path.join( self.watches[wd], os.fsdecode( name ) ) )
+        return rv
+
+    def close(self):
+        os.close( self.fd )
+
+class PollWatcher :
+    def __init__(self,paths,interval=1.0):
+        '''
+        PollWatcher Object:
+
+        paths: files or directories to watch by comparing their stat every interval
+               seconds, fallback when inotify is not available
+        '''
+        self.interval = interval
+        self.stats = {}
+        self.add( paths )
+
+    def add(self,paths):
+        '''
+        start watching paths, returns the ones that were not watched yet
+        '''
+        rv = set()
+        for path in paths:
+            if path not in self.stats:
+                self.stats[path] = PollWatcher.stat( path )
+                rv.add( path )
+        return rv
+
+    def __repr__(self):
+        return 'PollWatcher: %d files every %.1fs' %( len(self.stats), self.interval )
+
+    @staticmethod
+    def stat(path):
+        try:
+            return HashCache.stat_key( os.stat( path ) )
+        except OSError:
+            return None
+
+    def wait(self,timeout=None):
+        while True:
+            time.sleep( self.interval if timeout is None else min( timeout, self.interval ) )
+            rv = set()
+            for (path,previous) in self.stats.items():
+                current = PollWatcher.stat( path )
+                if current != previous:
+                    self.stats[path] = current
+                    rv.add( path )
+            if rv or timeout is not None:
+                return rv
+
+    def close(self):
+        pass
+
+class Transport(abc.ABC) :
+    def __init__(self,name,definition,cache=None):
+        '''
+        Transport Object: access to the files of one host of the fleet
+
+        name: name of the host in the inventory
+        definition: dict from the inventory describing how to reach the host
+        cache: optional HashCache used to avoid rehashing unchanged files
+
+        paths are absolute paths as seen on the host
+        '''
+        self.name = name
+        self.definition = definition
+        self.cache = cache
+
+    def __repr__(self):
+        return '%s: %s' %( type(self).__name__, self.name )
+
+    @abc.abstractmethod
+    def stat(self,path):
+        '''
+        stat of path on the host or None if it doesn't exist
+        '''
+
+    @abc.abstractmethod
+    def file_hash(self,path,st=None):
+        '''
+        sha256 of path on the host, st is its stat if already known
+        '''
+
+    @abc.abstractmethod
+    def put(self,copies):
+        '''
+        write the local files to the host as one batch, copies is a list of
+        (from_path, path) with path on the host
+        '''
+
+    def host_path(self,path):
+        '''
+        path on this machine where path on the host can be written, or None for a
+        remote host. When there is one, push queues the copies in the same journaled
+        and snapshotted batch as the other commands instead of calling put
+        '''
+        return None
+
+    def close(self):
+        pass
+
+class LocalTransport(Transport) :
+    def __init__(self,name,definition,cache=None):
+        '''
+        LocalTransport Object: a host whose file system is the directory
+        definition['root'] on this machine, for a mounted host or for tests
+        '''
+        Transport.__init__( self, name, definition, cache )
+        self.root = os.path.expanduser( definition['root'] )
+
+    def host_path(self,path):
+        return os.path.join( self.root, path.lstrip( '/' ) )
+
+    def stat(self,path):
+        try:
+            return os.stat( self.host_path( path ) )
+        except OSError:
+            return None
+
+    def file_hash(self,path,st=None):
+        if self.cache:
+            return self.cache.file_hash( self.host_path( path ), st )
+        return file_hash( self.host_path( path ) )
+
+    def put(self,copies):
+        journal_name = 'journal-host-{}.json'.format( hashlib.sha1( self.root.encode( 'utf-8' ) ).hexdigest()[:16] )
+        journal = ApplyJournal( os.path.join( cache_dir(), journal_name ) )
+        journal.recover()
+        for (from_path,path) in copies:
+            journal.add( from_path, self.host_path( path ) )
+        journal.apply()
+
+TRANSPORTS = { 'local':LocalTransport }
 
 class FilePair :
-    def __init__(self,dir,src_dir,file_rel_path):
+    def __init__(self,dir,src_dir,file_rel_path,cache=None):
         '''
         FilePair Object:
 
         dir: directory where the file is stored in git/sync repo (ex: /path/to/syncfiles/etc/apache2)
         src_dir: directory where the file is supposed to be (ex: /etc/apache2)
         file_rel_path: rel path inside dir and src_dir (ex: sites/default.conf )
+        cache: optional HashCache used to avoid rehashing unchanged files
         '''
         self.dir = dir
         self.src = src_dir
         self.file_rel_path = file_rel_path
+        self.cache = cache
+        self.match = None
+        # which side changed since the last sync according to the Manifest
+        self.change = None
+        # kind:digest of the source once it has been hashed
+        self.digest = None
+        # git blob id of the repo file when git's index says it is unchanged
+        self.dir_blob = None
 
     def __repr__(self):
         return 'FilePair: %s (%s %s)' %( self.file_rel_path, self.dir, self.src )
@@ -73,9 +1156,34 @@ class FilePair :
         return os.path.isfile( self.dir_file() )
 
     def is_match(self):
+        if self.match is None:
+            self.match = self.compute_match()
+        return self.match
+
+    def compute_match(self):
         if not self.src_is_readable() or not self.dir_is_readable():
             return False
-        return file_hash( self.dir_file() ) == file_hash( self.src_file() )
+        dir_stat = os.stat( self.dir_file() )
+        src_stat = os.stat( self.src_file() )
+        # different sizes can't match, no need to read anything
+        if dir_stat.st_size != src_stat.st_size:
+            return False
+        if self.dir_blob:
+            # only the source needs to be read, hashed the way git does
+            kind = 'blob256' if len(self.dir_blob) == 64 else 'blob'
+            self.digest = '{}:{}'.format( kind, self.hash( self.src_file(), src_stat, kind ) )
+            if self.digest == '{}:{}'.format( kind, self.dir_blob ):
+                return True
+            # the blob is the cleaned content, it differs from the work tree file
+            # when eol conversion or a filter applies, so compare the actual files
+        src_hash = self.hash( self.src_file(), src_stat )
+        self.digest = 'sha256:{}'.format( src_hash )
+        return self.hash( self.dir_file(), dir_stat ) == src_hash
+
+    def hash(self,filepath,st=None,kind='sha256'):
+        if self.cache:
+            return self.cache.file_hash( filepath, st, kind )
+        return file_hash( filepath, kind )
 
     def src_is_readable(self):
         return os.access( self.src_file(), os.R_OK )
@@ -92,6 +1200,58 @@ class Config :
         self.expand_dirs()
         self.max_len_dir = 0
         self.max_len_src = 0
+        self.hash_cache = HashCache( os.path.join( cache_dir(), 'hashes.json' ), rehash=self.args.rehash, verbose=self.verbose )
+        manifest_name = 'manifest-{}.json'.format( hashlib.sha1( self.basedir.encode( 'utf-8' ) ).hexdigest()[:16] )
+        self.manifest = Manifest( os.path.join( cache_dir(), manifest_name ), verbose=self.verbose )
+        journal_name = 'journal-{}.json'.format( hashlib.sha1( self.basedir.encode( 'utf-8' ) ).hexdigest()[:16] )
+        self.journal = ApplyJournal( os.path.join( cache_dir(), journal_name ), verbose=self.verbose )
+        self.journal.recover()
+        self.agreed = []
+        self.snapshots = SnapshotStore( os.path.join( data_dir(), 'snapshots' ) )
+
+    def save_state(self):
+        self.apply_changes()
+        self.hash_cache.save()
+        self.manifest.save()
+
+    def record_agreed(self,filepair):
+        '''
+        record in the manifest that both files of the pair will be identical once the changes are applied
+        '''
+        if not self.args.execute or filepair.change == Manifest.UNCHANGED:
+            return
+        self.agreed.append( filepair )
+
+    def apply_changes(self):
+        '''
+        snapshot the files about to be overwritten, copy all the files queued
+        by copyfile in one batch, then update the manifest
+        '''
+        if not self.args.nosnapshot and self.journal.copies:
+            self.snapshots.begin_batch()
+            for (from_path,to_path) in self.journal.copies:
+                self.snapshot_file( to_path )
+        self.journal.apply()
+        for filepair in self.agreed:
+            digest = filepair.digest if filepair.match else None
+            if digest is None:
+                digest = 'sha256:{}'.format( self.hash_cache.file_hash( filepair.src_file() ) )
+            self.manifest.record( filepair, digest )
+        self.agreed = []
+
+    def snapshot_file(self,filepath):
+        '''
+        save filepath in the snapshot store, reusing its digest if it was already computed
+        '''
+        try:
+            st = os.stat( filepath )
+        except FileNotFoundError:
+            return None
+        digest = self.snapshots.snapshot( filepath, st, self.hash_cache.cached_hash( filepath, st ) )
+        self.hash_cache.remember( filepath, st, 'sha256', digest )
+        if self.verbose:
+            print( 'SNAPSHOT: {} {}'.format( digest[:12], filepath ) )
+        return digest
 
     def find_config_file(self):
         '''
@@ -131,9 +1291,10 @@ class Config :
             print( 'CONFIG: {} base={} git={}'.format(candidate,self.basedir, self.git_root ) )
 
     def validate_config(self):
+        self.host_facts = HostFacts()
         valid = True
         if 'validate' in self.defs:
-            valid = eval( self.defs['validate'] )
+            valid = self.check_predicate( self.defs['validate'] )
             if not valid:
                 if not self.args.force:
                     print( 'Skipping, Validation "{}" evaluates to False'.format( self.defs['validate'] ) )
@@ -147,12 +1308,21 @@ class Config :
                     print( 'CONTINUE: Validation "{}" evaluates to True'.format( self.defs['validate'] ) );
                     
         return valid
+
+    def check_predicate(self,text):
+        try:
+            predicate = compile_predicate( text )
+        except ValueError as err:
+            print( 'Invalid validation "{}": {}'.format( text, err ) )
+            sys.exit( 1 )
+        return predicate.evaluate( self.host_facts )
     
     def expand_dirs(self):
         '''
           Find all the source dir and destination dir relevant from the config file
           basedir = '/path/to/base'
           Ex: dirmap: 'etc/apache2': '/etc/apache2'
+              or 'etc/apache2': {'src':'/etc/apache2','validate':'os:linux'}
                dir_to_src = { '/path/to/base/etc/apache2': '/etc/apache2', '/path/to/base/bin }
                src_to_dir = { '/etc/apache2': 'etc/apache2', '/Users/xxx/bin':'bin' }
                src_to_src = { '/etc/apache2': '/etc/apache2', '/Users/xxx/bin': '~/bin' } 
@@ -162,7 +1332,16 @@ class Config :
         self.expand_src_to_dir = {}
         self.expand_src_to_src = {}
 
+        disabled = []
         for (dir,src) in self.defs["dirmap"].items():
+            if isinstance( src, dict ):
+                if 'validate' in src and not self.args.force and not self.check_predicate( src['validate'] ):
+                    if self.verbose:
+                        print( 'SKIP: {} validation "{}" evaluates to False'.format( dir, src['validate'] ) )
+                    if dir != '.':
+                        disabled.append( '/' + dir.strip( '/' ) )
+                    continue
+                src = src['src']
             if( dir == '.'):
                 expand_dir = self.basedir
             else:
@@ -174,28 +1353,21 @@ class Config :
             self.expand_src_to_dir[expand_src] = dir
             self.expand_src_to_src[expand_src] = src
         
-        # Always ignore syncfiles
-        self.ignore_map = {os.path.join( self.basedir, '.syncfiles' ):1}
-        self.ignore_pattern = {}
-        if 'ignore' in self.defs:
-            for dir in self.defs['ignore']:
-                to_ignore = os.path.join( self.basedir, dir )
-                if os.path.exists( to_ignore ):
-                    self.ignore_map[to_ignore] = 1
-                else:
-                    self.ignore_pattern[ dir ] = 1
+        # Always ignore syncfiles, the fleet inventory and the dirmaps not valid on this host, last so it can't be negated
+        rules = self.defs.get( 'ignore', [] ) + disabled + [ '/.syncfiles', '/.syncfiles-hosts' ]
+        self.ignore_matcher = compile_ignore( tuple( rules ) )
 
-    def should_ignore(self,filepath,rel_file):
-        for ignore_path in self.ignore_map:
-            if filepath.startswith( ignore_path ):
-                return True
+    def should_ignore(self,filepath,is_dir=False):
+        if not filepath.startswith( self.basedir + '/' ):
+            return False
+        return self.ignore_matcher.match( filepath[len(self.basedir)+1:], is_dir )
 
-        for pattern in self.ignore_pattern:
-            if fnmatch.fnmatch( filepath, pattern ):
-                return True
+    def new_pair(self,dir,src,rel_path):
+        pair = FilePair( dir, src, rel_path, self.hash_cache )
+        self.max_len_dir = max(self.max_len_dir, len(self.display_dir_file(pair)))
+        self.max_len_src = max(self.max_len_src, len(self.display_src_file(pair)))
+        return pair
 
-        return False
-            
     def construct_file_pairs(self,files):
         '''
            Input is array, each entry:
@@ -220,10 +1392,7 @@ class Config :
                             if self.verbose:
                                 print( '%s %s %s'%(dir_path, src, rel_path) )
 
-                            pair = FilePair( dir_path, src, rel_path )
-                            self.max_len_dir = max(self.max_len_dir, len(self.display_dir_file(pair)))
-                            self.max_len_src = max(self.max_len_src, len(self.display_src_file(pair)))
-                            rv += [ pair ]
+                            rv += [ self.new_pair( dir_path, src, rel_path ) ]
 
                         else:
                             if self.verbose:
@@ -249,10 +1418,7 @@ class Config :
                         print( 'Candidate {}'.format(candidate) )
                     if os.path.isfile( candidate ):
                         rel_path = x
-                        pair = FilePair( dir, src_path, rel_path )
-                        self.max_len_dir = max(self.max_len_dir, len(self.display_dir_file(pair)))
-                        self.max_len_src = max(self.max_len_src, len(self.display_src_file(pair)))
-                        rv += [ pair ]
+                        rv += [ self.new_pair( dir, src_path, rel_path ) ]
 
         return rv
 
@@ -261,12 +1427,11 @@ class Config :
         rel_dir is None to look at all the source or the relative director off the src base
         rel_src is None or the src the rel_dir is off
 
-        returns all the file pairs below that directory
+        generates all the file pairs below that directory
 
         Ex: source = /etc/apache2 -> rel_dir = apache2, rel_src = /etc
         '''
 
-        file_pairs = []
         for (dir,src) in self.expand_dir_to_src.items():
             if self.verbose:
                 print( 'LOOK: dir={} src={}'.format( dir, src ) )
@@ -275,69 +1440,101 @@ class Config :
                 continue
             if not os.path.isdir( search_dir ):
                 continue
-            dir_files = os.listdir( search_dir )
+            yield from self.scan_file_pairs( dir, src, search_dir, rel_dir )
 
-            for dir_file in dir_files:
-                rel_file = dir_file if rel_dir is None else os.path.join(rel_dir, dir_file)
-                full_dir_file = os.path.join(search_dir,dir_file)
-
-                if self.should_ignore( full_dir_file, rel_file ):
+    def scan_file_pairs(self,dir,src,search_dir,rel_dir):
+        '''
+        walk search_dir with scandir, ignored directories are pruned without being read
+        '''
+        try:
+            entries = os.scandir( search_dir )
+        except OSError:
+            return
+
+        with entries:
+            for entry in entries:
+                rel_file = entry.name if rel_dir is None else os.path.join(rel_dir, entry.name)
+                full_dir_file = entry.path
+                is_dir = entry.is_dir()
+
+                if self.should_ignore( full_dir_file, is_dir ):
                     if self.verbose:
                         print( "IGNORE: file %s" %(full_dir_file,) )
                     continue
 
-                if os.path.isdir( full_dir_file ):
-                    if not full_dir_file in self.expand_dir_to_src:
-                        next_rel_dir = dir_file if rel_dir is None else os.path.join( rel_dir, dir_file )
-                        file_pairs += self.discover_file_pairs(next_rel_dir,src)
-
+                if full_dir_file in self.expand_dir_to_src:
+                    if self.verbose:
+                        print( "SKIP: source %s" %(full_dir_file,) )
+                elif is_dir:
+                    yield from self.scan_file_pairs( dir, src, full_dir_file, rel_file )
                 else:
-                    if full_dir_file in self.expand_dir_to_src:
-                        if self.verbose:
-                            print( "SKIP: source %s" %(full_dir_file,) )
-                    else:
-                        pair = FilePair( dir, src, rel_file )
-                        if self.verbose:
-                            print( 'FOUND: discovered %s'%(pair,) )
-                        self.max_len_dir = max(self.max_len_dir, len(self.display_dir_file(pair)))
-                        self.max_len_src = max(self.max_len_src, len(self.display_src_file(pair)))
-                        file_pairs += [ pair ]
-        return file_pairs
+                    pair = self.new_pair( dir, src, rel_file )
+                    if self.verbose:
+                        print( 'FOUND: discovered %s'%(pair,) )
+                    yield pair
 
 
     def construct_git_pairs(self):
+        '''
+        file pairs for the files tracked by git. When git's index says the file
+        in the repo is unchanged, its blob id is used instead of hashing it
+        '''
         file_pairs = []
-        cmd = [ 'git', 'ls-files' ]
+        cmd = [ 'git', 'ls-files', '-s', '-z' ]
         if self.args.files:
-            cmd += self.args.files
+            cmd += [ '--' ] + self.args.files
         git_ls_out = subprocess.run( cmd, capture_output=True)
+        entries = []
         if git_ls_out.returncode == 0:
-            files = git_ls_out.stdout.decode( 'utf-8' ).splitlines()
-
-        for one in files:
-            full_path_file = os.path.join( os.getcwd(), one )
-            found_dir = None
-            for (repo_dir,src_dir) in self.expand_dir_to_src.items():
-                if full_path_file.startswith( repo_dir ) and ( found_dir is None or len(found_dir) < len( repo_dir) ):
-                    found_dir = repo_dir
+            entries = git_ls_out.stdout.decode( 'utf-8' ).split( '\0' )
+
+        modified = self.git_modified_files()
+        dir_index = PrefixIndex( self.expand_dir_to_src )
+        cwd = os.getcwd()
+        done = set()
+
+        for entry in entries:
+            if not entry:
+                continue
+            (info,one) = entry.split( '\t', 1 )
+            (mode,blob,stage) = info.split( ' ' )
+            if one in done:
+                continue
+            done.add( one )
+
+            full_path_file = os.path.join( cwd, one )
+            found_dir = dir_index.longest_prefix( full_path_file )
             if found_dir:
                 # in repo (+1 for the /)
                 file_rel_path = full_path_file[ len(found_dir)+1: ]
 
-                if self.should_ignore( full_path_file, file_rel_path ):
+                if self.should_ignore( full_path_file ):
                     if self.verbose:
                         print( "IGNORE: file {}".format( full_path_file ) )
                     continue
 
-                pair = FilePair(found_dir, self.expand_dir_to_src[found_dir], file_rel_path);
-                self.max_len_dir = max(self.max_len_dir, len(self.display_dir_file(pair)))
-                self.max_len_src = max(self.max_len_src, len(self.display_src_file(pair)))
+                pair = self.new_pair(found_dir, self.expand_dir_to_src[found_dir], file_rel_path)
+                # only regular files merged in the index have a blob matching the content
+                if stage == '0' and mode in ( '100644', '100755' ) and modified is not None and one not in modified:
+                    pair.dir_blob = blob
                 file_pairs += [ pair ]
                 if self.verbose:
                     print( 'FOUND: from git {}'.format(pair) )
                 
         return file_pairs
-    
+
+    def git_modified_files(self):
+        '''
+        files whose stat in the work tree differs from git's index, relative to the current directory
+        '''
+        cmd = [ 'git', 'diff-files', '--name-only', '--relative', '-z' ]
+        if self.args.files:
+            cmd += [ '--' ] + self.args.files
+        git_diff_out = subprocess.run( cmd, capture_output=True )
+        if git_diff_out.returncode != 0:
+            return None
+        return set( git_diff_out.stdout.decode( 'utf-8' ).split( '\0' ) )
+
     def list_file_pairs(self):
         if self.git_root:
             return self.construct_git_pairs()
@@ -346,47 +1543,148 @@ class Config :
         else:
             return self.discover_file_pairs()
     
-    def display_dir_file(self, filepair ):
+    def match_file_pairs(self):
+        '''
+        list the file pairs with their match state already computed,
+        using a pool of --jobs threads. The order of the list is unchanged
+        '''
+        return self.match_pairs( list(self.list_file_pairs()) )
+
+    def match_pairs(self, pairs):
+        for x in self.iter_match_pairs( pairs ):
+            pass
+        return pairs
+
+    def iter_match_pairs(self, pairs):
+        '''
+        generate the pairs in order as soon as their match state is computed,
+        using --jobs threads with a bounded number of pairs in flight.
+        With --verbose, reports the speedup once all the pairs are done
+        '''
+        start = time.perf_counter()
+        busy = 0.0
+        count = 0
+        if self.args.jobs <= 1:
+            for x in pairs:
+                busy += self.timed_match( x )
+                count += 1
+                yield x
+        else:
+            with thread_pool( self.args.jobs ) as executor:
+                pending = collections.deque()
+                for x in pairs:
+                    pending.append( (x, executor.submit( self.timed_match, x ) ) )
+                    if len(pending) >= 4 * self.args.jobs:
+                        (done,future) = pending.popleft()
+                        busy += future.result()
+                        count += 1
+                        yield done
+                while pending:
+                    (done,future) = pending.popleft()
+                    busy += future.result()
+                    count += 1
+                    yield done
+        wall = time.perf_counter() - start
+        if self.verbose:
+            print( 'MATCH: {} pairs in {:.3f}s with {} jobs, {:.3f}s of work, speedup {:.1f}x'.format(
+                count, wall, self.args.jobs, busy, busy / wall if wall > 0 else 1.0 ) )
+
+    def timed_match(self, filepair):
+        start = time.perf_counter()
+        if filepair.src_file_exists():
+            filepair.change = self.manifest.classify( filepair )
+            if filepair.change == Manifest.UNCHANGED and not self.args.rehash and not self.manifest.is_racy( filepair ):
+                filepair.match = True
+            elif filepair.is_match() and filepair.change == Manifest.UNCHANGED:
+                # recorded with racy stats, now verified, record it again once the stats settled
+                self.manifest.record( filepair, filepair.digest )
+        return time.perf_counter() - start
+
+    def dir_path(self, filepair ):
         dir_path = self.expand_src_to_dir[filepair.src]
         if dir_path == '.':
-            return filepair.file_rel_path.ljust(self.max_len_dir,' ' )
+            return filepair.file_rel_path
         else:
-            return os.path.join( dir_path, filepair.file_rel_path).ljust(self.max_len_dir, ' ')
+            return os.path.join( dir_path, filepair.file_rel_path)
 
-
-    def display_src_file(self, filepair):
+    def src_path(self, filepair):
         src_path = self.expand_src_to_src[filepair.src]
         if src_path == '.':
-            return filepair.file_rel_path.ljust(self.max_len_src,' ')
+            return filepair.file_rel_path
         else:
-            return os.path.join( src_path, filepair.file_rel_path).ljust(self.max_len_src,' ')
-        
+            return os.path.join( src_path, filepair.file_rel_path)
+
+    def display_dir_file(self, filepair ):
+        return self.dir_path( filepair ).ljust(self.max_len_dir, ' ')
+
+    def display_src_file(self, filepair):
+        return self.src_path( filepair ).ljust(self.max_len_src,' ')
 
     def output_status(self, file_pair ):
         status = self.format_status( file_pair );
         if status:
-            print( status );
+            print( status, flush=True );
 
         return status
-            
-    def format_status(self, filepair ):
+
+    def pair_state(self, filepair ):
+        '''
+        returns (flag, direction) where flag is
+          . same, M modified, C modified on both sides since the last sync,
+          ? source missing, ! source not readable, A repo file not readable
+        and direction is < or > for the way sync would copy the files
+        '''
         if filepair.src_file_exists():
             if not filepair.src_is_readable():
-                return '! %s   %s' %(self.display_dir_file(filepair), self.display_src_file(filepair) )
+                return ('!','')
             elif not filepair.dir_is_readable():
-                return 'A %s   %s' %(self.display_dir_file(filepair), self.display_src_file(filepair) )
+                return ('A','')
+            elif filepair.is_match():
+                return ('.','=')
             else:
-                if filepair.is_match():
-                    if self.args.all:
-                        return '. %s = %s' %(self.display_dir_file(filepair), self.display_src_file(filepair) )
-                    else:
-                        return '';
-                else:
-                    return 'M %s %s %s' %(self.display_dir_file(filepair), self.display_compare_dir_src(filepair), self.display_src_file(filepair) )
-        else:
+                flag = 'C' if filepair.change == Manifest.BOTH else 'M'
+                return (flag,self.display_compare_dir_src(filepair))
+        return ('?','')
+
+    def format_status(self, filepair ):
+        (flag,direction) = self.pair_state( filepair )
+        if flag in '!A':
+            return '%s %s   %s' %(flag, self.display_dir_file(filepair), self.display_src_file(filepair) )
+        elif flag == '.':
+            if self.args.all:
+                return '. %s = %s' %(self.display_dir_file(filepair), self.display_src_file(filepair) )
+            else:
+                return '';
+        elif flag == '?':
             return '? %s  [%s]' %(self.display_dir_file(filepair), self.display_src_file(filepair) )
+        else:
+            return '%s %s %s %s' %(flag, self.display_dir_file(filepair), direction, self.display_src_file(filepair) )
+
+    def output_machine_status(self, filepair ):
+        '''
+        output the status of one pair as a json line or in porcelain format, unpadded and flushed
+        '''
+        (flag,direction) = self.pair_state( filepair )
+        if flag == '.' and not self.args.all:
+            return False
+        if self.args.format == 'jsonl':
+            line = json.dumps( {'status':flag,'direction':direction,'change':filepair.change,
+                                'dir':self.dir_path( filepair ),'src':self.src_path( filepair ),
+                                'dir_file':filepair.dir_file(),'src_file':filepair.src_file()} ) + '\n'
+        else:
+            # porcelain: "XY repo_path<sep>src_path<end>", with -z paths are never split
+            (sep,end) = ('\0','\0') if self.args.z else ('\t','\n')
+            line = '{}{} {}{}{}{}'.format( flag, direction or ' ', self.dir_path( filepair ), sep, self.src_path( filepair ), end )
+        sys.stdout.write( line )
+        sys.stdout.flush()
+        return True
 
     def display_compare_dir_src(self, filepair ):
+        if filepair.change == Manifest.SRC:
+            return '<'
+        elif filepair.change == Manifest.DIR:
+            return '>'
+
         m_src = os.path.getmtime( filepair.src_file() )
         m_dir = os.path.getmtime( filepair.dir_file() )
 
@@ -396,45 +1694,164 @@ class Config :
 
 
     def cmd_sync(self):
-        exists = [x for x in self.list_file_pairs() if x.src_file_exists() ]
+        self.sync_pairs( self.match_file_pairs() )
+        self.execute_warning()
+
+    def sync_pairs(self, pairs):
+        exists = [x for x in pairs if x.src_file_exists() ]
 
         for x in exists:
-            if not x.is_match():
+            if x.is_match():
+                self.record_agreed(x)
+            else:
                 if not x.src_is_readable():
                     print( 'cannot read: %s' % (x.src_file(),) )
                 elif not x.dir_is_readable():
                     print( 'cannot read: %s' %(x.dir_file(),))
+                elif x.change == Manifest.BOTH:
+                    print( 'conflict: {} and {} both changed, use pull or push'.format( x.dir_file(), x.src_file() ) )
                 else:
-                    m_src = os.path.getmtime( x.src_file() )
-                    m_dir = os.path.getmtime( x.dir_file() )
-                    if m_dir < m_src:
+                    if x.change in (Manifest.SRC, Manifest.DIR):
+                        to_dir = x.change == Manifest.SRC
+                    else:
+                        to_dir = os.path.getmtime( x.dir_file() ) < os.path.getmtime( x.src_file() )
+                    if to_dir:
                         self.copyfile(x.src_file(), x.dir_file() )
                     else:
                         self.copyfile(x.dir_file(), x.src_file() )
+                    self.record_agreed(x)
 
-        self.execute_warning()
+    def cmd_watch(self):
+        '''
+        sync, then wait for files to change and only recheck and sync the affected pairs
+        '''
+        pairs = self.match_file_pairs()
+        self.sync_pairs( pairs )
+        self.save_state()
+
+        pairs_by_path = {}
+        for x in pairs:
+            pairs_by_path[x.dir_file()] = x
+            pairs_by_path[x.src_file()] = x
+
+        watcher = None
+        if not self.args.poll:
+            try:
+                watcher = InotifyWatcher( self.watch_dirs( pairs ) )
+            except OSError as err:
+                if self.verbose:
+                    print( 'WATCH: inotify unavailable ({}), polling'.format( err ) )
+        if watcher is None:
+            # the stat of a directory changes when a file is created in it
+            watcher = PollWatcher( list(pairs_by_path) + sorted( self.watch_dirs( pairs ) ), self.args.interval )
+        if self.verbose:
+            print( 'WATCH: {} pairs with {}'.format( len(pairs), watcher ) )
+        dir_index = PrefixIndex( self.expand_dir_to_src )
+        root_index = PrefixIndex( list(self.expand_dir_to_src) + list(self.expand_dir_to_src.values()) )
+
+        try:
+            while True:
+                changed = watcher.wait()
+                # let a burst of events settle before looking at the files
+                more = changed
+                while more:
+                    more = watcher.wait( self.args.debounce )
+                    changed |= more
+
+                # new directories are watched and new files in the repo are looked for again
+                new_dirs = set()
+                rediscover = False
+                for path in changed:
+                    if path in pairs_by_path or not os.path.exists( path ):
+                        continue
+                    if os.path.isdir( path ):
+                        if root_index.longest_prefix( path ):
+                            rediscover = True
+                            for (dirpath,dirnames,filenames) in os.walk( path ):
+                                new_dirs.add( dirpath )
+                        elif any( [ x.startswith( path + '/' ) for x in root_index.keys ] ):
+                            # a parent of a root that does not exist yet, the watch moves deeper
+                            rediscover = True
+                    elif dir_index.longest_prefix( path ) and not self.should_ignore( path ):
+                        rediscover = True
+                if rediscover:
+                    for x in self.list_file_pairs():
+                        if x.dir_file() not in pairs_by_path:
+                            pairs.append( x )
+                            pairs_by_path[x.dir_file()] = x
+                            pairs_by_path[x.src_file()] = x
+                            changed.add( x.dir_file() )
+                    new_dirs = watcher.add( new_dirs | self.watch_dirs( pairs ) )
+                    if new_dirs:
+                        # files may have been written in them before they were watched
+                        new_index = PrefixIndex( new_dirs )
+                        changed |= set( [ x for x in pairs_by_path if new_index.longest_prefix( x ) ] )
+                    if isinstance( watcher, PollWatcher ):
+                        watcher.add( pairs_by_path )
+
+                affected = []
+                for path in sorted(changed):
+                    x = pairs_by_path.get( path )
+                    if x and x not in affected:
+                        x.match = None
+                        x.change = None
+                        # the blob from git's index may no longer describe the repo file
+                        x.dir_blob = None
+                        affected.append( x )
+                if affected:
+                    if self.verbose:
+                        print( 'WATCH: {} changed'.format( ', '.join( [ x.file_rel_path for x in affected ] ) ) )
+                    self.sync_pairs( self.match_pairs( affected ) )
+                    self.save_state()
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    def watch_dirs(self,pairs):
+        '''
+        directories of the files of the pairs and the roots of the dirmaps, for a
+        root that does not exist yet its nearest existing parent
+        '''
+        rv = set()
+        for x in pairs:
+            rv.add( os.path.dirname( x.dir_file() ) )
+            rv.add( os.path.dirname( x.src_file() ) )
+        for (dir,src) in self.expand_dir_to_src.items():
+            for root in (dir,src):
+                while not os.path.isdir( root ) and os.path.dirname( root ) != root:
+                    root = os.path.dirname( root )
+                rv.add( root )
+        return set( [ x for x in rv if os.path.isdir( x ) ] )
 
     def cmd_pull(self):
-        exists = [x for x in self.list_file_pairs() if x.src_file_exists() ]
+        exists = [x for x in self.match_file_pairs() if x.src_file_exists() ]
 
         for x in exists:
-            if not x.is_match():
+            if x.is_match():
+                self.record_agreed(x)
+            else:
                 if not x.src_is_readable():
                     print( 'cannot read: %s' % (x.src_file(),) )
                 elif not x.dir_is_readable():
                     print( 'cannot read: %s' %(x.dir_file(),))
                 else:
                     self.copyfile(x.src_file(), x.dir_file() )
+                    self.record_agreed(x)
                     
         self.execute_warning()
 
 
     def cmd_push(self):
-        exists = [x for x in self.list_file_pairs() if x.src_file_exists() ]
+        exists = [x for x in self.match_file_pairs() if x.src_file_exists() ]
 
         for x in exists:
-            if not x.is_match():
+            if x.is_match():
+                self.record_agreed(x)
+            else:
                 self.copyfile(x.dir_file(), x.src_file() )
+                self.record_agreed(x)
 
         self.execute_warning()
                     
@@ -442,12 +1859,7 @@ class Config :
     def copyfile(self,from_path,to_path):
         if self.args.execute:
             print( 'cp {} {}'.format(from_path, to_path ) )
-            try:
-                shutil.copyfile( from_path, to_path )
-            except IOError as io_err:
-                to_dir = os.path.dirname( to_path )
-                os.makedirs( to_dir )
-                shutil.copyfile( from_path, to_path )
+            self.journal.add( from_path, to_path )
         else:    
             print( 'cp {} {}'.format(from_path, to_path ) )
             
@@ -456,20 +1868,130 @@ class Config :
             print()
             print( 'Preview mode. Files were not copied, add --execute option to copy' )
         
+    def load_inventory(self):
+        '''
+        list of Transport for the hosts of the inventory, a json dict of host name
+        to definition, ex: {"web1":{"transport":"local","root":"/mnt/web1"}}
+        '''
+        inventory_path = self.args.inventory or os.path.join( self.basedir, '.syncfiles-hosts' )
+        try:
+            with open( inventory_path, 'r' ) as inventory_file:
+                inventory = json.load( inventory_file )
+        except (OSError, ValueError) as err:
+            print( 'Invalid inventory {}: {}'.format( inventory_path, err ) )
+            sys.exit( 1 )
+
+        rv = []
+        for (name,definition) in inventory.items():
+            transport = definition.get( 'transport', 'local' )
+            if transport not in TRANSPORTS:
+                print( 'Unknown transport "{}" for host {}, use one of {}'.format( transport, name, ', '.join( TRANSPORTS ) ) )
+                sys.exit( 1 )
+            rv.append( TRANSPORTS[transport]( name, definition, self.hash_cache ) )
+        return rv
+
+    def repo_digest(self,filepair):
+        if not filepair.dir_is_readable():
+            return None
+        st = os.stat( filepair.dir_file() )
+        return (st.st_size, self.hash_cache.file_hash( filepair.dir_file(), st ))
+
+    def fleet_host(self,transport,pairs,repo_digests):
+        '''
+        returns the list of (flag, pair) for one host
+        '''
+        rv = []
+        for x in pairs:
+            digest = repo_digests[x]
+            if digest is None:
+                rv.append( ('A',x) )
+                continue
+            st = transport.stat( x.src_file() )
+            if st is None:
+                flag = '?'
+            elif st.st_size != digest[0] or transport.file_hash( x.src_file(), st ) != digest[1]:
+                flag = 'M'
+            else:
+                flag = '.'
+            rv.append( (flag,x) )
+        return rv
+
+    def push_host(self,transport,copies):
+        '''
+        copy the files to the host, through the journaled batch of this run when
+        the host paths are writable from this machine, else with the transport put
+        '''
+        if not copies:
+            return
+        if transport.host_path( copies[0][1] ) is not None:
+            # applied with the other copies when the state is saved
+            for (from_path,path) in copies:
+                self.copyfile( from_path, transport.host_path( path ) )
+            return
+        for (from_path,path) in copies:
+            print( 'cp {} {}:{}'.format( from_path, transport.name, path ) )
+        if self.args.execute:
+            transport.put( copies )
+
+    def cmd_fleet(self):
+        '''
+        fleet [status|push] [FILES]: compare or push the repo to every host of the inventory
+        '''
+        action = 'status'
+        if self.args.files and self.args.files[0] in ('status','push'):
+            action = self.args.files[0]
+            self.args.files = self.args.files[1:]
+        hosts = self.load_inventory()
+        pairs = list(self.list_file_pairs())
+
+        # the repo side is hashed once and shared by all the hosts
+        with thread_pool( max( self.args.jobs, 1 ) ) as executor:
+            repo_digests = dict( zip( pairs, executor.map( self.repo_digest, pairs ) ) )
+
+        with thread_pool( max( len(hosts), 1 ) ) as executor:
+            futures = [ executor.submit( self.fleet_host, x, pairs, repo_digests ) for x in hosts ]
+
+            for (transport,future) in zip( hosts, futures ):
+                try:
+                    results = future.result()
+                    counts = collections.Counter( [ flag for (flag,x) in results ] )
+                    print( '{}: {} same, {} modified, {} missing, {} unreadable in repo'.format(
+                        transport.name, counts['.'], counts['M'], counts['?'], counts['A'] ) )
+                    for (flag,x) in results:
+                        if flag != '.' or self.args.all:
+                            print( '  {} {} {}'.format( flag, self.display_dir_file(x), self.src_path(x) ) )
+                    if action == 'push':
+                        self.push_host( transport, [ (x.dir_file(),x.src_file()) for (flag,x) in results if flag in 'M?' ] )
+                except Exception as err:
+                    print( '{}: failed {}'.format( transport.name, err ) )
+                finally:
+                    transport.close()
+
+        if action == 'push':
+            self.execute_warning()
+
     def cmd_install(self):
-        for x in self.list_file_pairs():
+        for x in self.match_file_pairs():
             if not x.src_file_exists() or not x.is_match():
                 self.copyfile(x.dir_file(), x.src_file() )
+            self.record_agreed(x)
 
         self.execute_warning()
                     
     def cmd_status(self):
-        exists = [ x for x in self.list_file_pairs() if x.src_file_exists() ]
-        unknown = [ x for x in self.list_file_pairs() if not x.src_file_exists() ]
-
+        if self.args.format != 'human':
+            for x in self.iter_match_pairs( self.list_file_pairs() ):
+                self.output_machine_status(x)
+            return
+
+        # listing the pairs first sets the column widths, the matches are still printed as they complete
+        pairs = list( self.list_file_pairs() )
+        unknown = []
         done = False
-        for x in exists:
-            if self.output_status(x):
+        for x in self.iter_match_pairs( pairs ):
+            if not x.src_file_exists():
+                unknown.append( x )
+            elif self.output_status(x):
                 done = True;
 
         for x in unknown:
@@ -479,6 +2001,57 @@ class Config :
             print( 'All up to date' )
 
 
+    def cmd_cache(self):
+        '''
+        cache [list|prune|clear]: inspect or maintain the persistent hash cache
+        '''
+        action = self.args.files[0] if self.args.files else 'info'
+        cache = self.hash_cache
+        if action == 'list':
+            for filepath,entry in sorted(cache.entries.items()):
+                for kind,digest in sorted(entry[3].items()):
+                    print( '{:<4} {} {:>10} {}'.format( kind, digest, entry[0], filepath ) )
+        elif action == 'prune':
+            removed = cache.prune()
+            print( 'Pruned {} stale entries, {} left'.format( removed, len(cache.entries) ) )
+        elif action == 'clear':
+            cache.clear()
+            print( 'Cleared {}'.format( cache.path ) )
+        else:
+            size = os.path.getsize( cache.path ) if os.path.isfile( cache.path ) else 0
+            print( '{}: {} entries, {} bytes'.format( cache.path, len(cache.entries), size ) )
+
+    def cmd_restore(self):
+        '''
+        restore: list the snapshots
+        restore TIMESTAMP [FILES]: restore the files saved by the runs whose time
+        starts with TIMESTAMP, only the given FILES if any. When several snapshots
+        of a file match, the oldest is used
+        '''
+        entries = self.snapshots.entries()
+        if not self.args.files:
+            for entry in entries:
+                print( '{} {} {:>10} {}'.format( entry['time'], entry['sha256'][:12], entry['size'], entry['path'] ) )
+            return
+
+        prefix = self.args.files[0]
+        paths = [ os.path.abspath( os.path.expanduser( x ) ) for x in self.args.files[1:] ]
+        selected = {}
+        for entry in entries:
+            if entry['time'].startswith( prefix ) and (not paths or entry['path'] in paths):
+                selected.setdefault( entry['path'], entry )
+
+        if not selected:
+            print( 'No snapshot matching {}'.format( prefix ) )
+        self.snapshots.begin_batch()
+        for (path,entry) in selected.items():
+            print( 'restore {} from {}'.format( path, entry['time'] ) )
+            if self.args.execute:
+                if not self.args.nosnapshot:
+                    self.snapshot_file( path )
+                self.snapshots.restore( entry )
+        self.execute_warning()
+
     def cmd_apply(self,fns):
         exists = [ x for x in self.list_file_pairs() if x.src_file_exists() ]
         for x in exists:
@@ -487,9 +2060,9 @@ class Config :
     def cmd_difftool(self):
         tool = None
         if self.args.difftool == 'auto':
-            if distutils.spawn.find_executable( 'ksdiff' ):
+            if shutil.which( 'ksdiff' ):
                 tool = ['ksdiff', '--partial-changeset']
-            elif distutils.spawn.find_executable( 'icdiff' ):
+            elif shutil.which( 'icdiff' ):
                 tool = ['icdiff']
             else:
                 tool = ['vimdiff']
@@ -500,7 +2073,7 @@ class Config :
         elif self.args.difftool.startswith( 'v' ):
                 tool = ['vimdiff']
             
-        exists = [ x for x in self.list_file_pairs() if x.src_file_exists() ]
+        exists = [ x for x in self.match_file_pairs() if x.src_file_exists() ]
         for x in exists:
             if not x.is_match():
                 self.output_status(x)
@@ -508,28 +2081,82 @@ class Config :
 
                 subprocess.call( process_arg )
 
-    def cmd_diff(self):
-        exists = [ x for x in self.list_file_pairs() if x.src_file_exists() ]
+    def diff_pair(self, filepair):
+        '''
+        returns (unified diff lines, lines added, lines removed) from the repo file to the source,
+        the diff is None for binary files
+        '''
+        dir_lines = read_lines( filepair.dir_file() )
+        src_lines = read_lines( filepair.src_file() )
+        if dir_lines is None or src_lines is None:
+            return (None,0,0)
+
+        diff = []
+        added = 0
+        removed = 0
+        import difflib
+        for line in difflib.unified_diff( dir_lines, src_lines, filepair.dir_file(), filepair.src_file() ):
+            if not line.endswith( '\n' ):
+                line += '\n\\ No newline at end of file\n'
+            diff.append( line )
+        for line in diff[2:]:
+            if line.startswith( '+' ):
+                added += 1
+            elif line.startswith( '-' ):
+                removed += 1
+        return (diff,added,removed)
 
-        for x in exists:
-            if not x.src_is_readable():
-                continue
-            if not x.is_match():
+    def cmd_diff(self):
+        modified = [ x for x in self.match_file_pairs() if x.src_file_exists() and x.src_is_readable() and x.dir_is_readable() and not x.is_match() ]
+
+        stats = []
+        with thread_pool( max( self.args.jobs, 1 ) ) as executor:
+            # map keeps the order, each diff is output as soon as it and the ones before are done
+            for (x,(diff,added,removed)) in zip( modified, executor.map( self.diff_pair, modified ) ):
+                if self.args.stat:
+                    stats.append( (x,diff,added,removed) )
+                    continue
                 self.output_status(x)
-                subprocess.call( [ 'diff', x.dir_file(), x.src_file() ]  )
-
-if __name__ == "__main__":
-                
-    commands = {
-        'status':{'attr':'cmd_status','help':'Show status of files'},
-        'install':{'attr':'cmd_install','help':'Copy all the missing files to source'},
-        'diff':{'attr':'cmd_diff','help':'Show diff for modified files'},
-        'difftool':{'attr':'cmd_difftool','help':'Show diff for modified files in ksdiff or vimdiff'},
-        'sync':{'attr':'cmd_sync','help':'copy most recent files to older one'},
-        'pull':{'attr':'cmd_pull','help':'copy to local the original files'},
-        'push':{'attr':'cmd_push','help':'push local file to the original location'}
-    }
-    
+                if diff is None:
+                    print( 'Binary files {} and {} differ'.format( x.dir_file(), x.src_file() ) )
+                else:
+                    sys.stdout.writelines( diff )
+
+        if self.args.stat:
+            self.output_diff_stat( stats )
+
+    def output_diff_stat(self, stats):
+        width = max( [ len(self.display_dir_file(x).rstrip()) for (x,diff,added,removed) in stats ] + [0] )
+        most = max( [ added + removed for (x,diff,added,removed) in stats ] + [1] )
+        scale = min( 1.0, 50.0 / most )
+        total_added = 0
+        total_removed = 0
+        for (x,diff,added,removed) in stats:
+            name = self.display_dir_file(x).rstrip().ljust( width )
+            if diff is None:
+                print( ' {} | Bin'.format( name ) )
+            else:
+                bar = '+' * int( round( added * scale ) ) + '-' * int( round( removed * scale ) )
+                print( ' {} | {:>5} {}'.format( name, added + removed, bar ) )
+            total_added += added
+            total_removed += removed
+        print( ' {} files changed, {} insertions(+), {} deletions(-)'.format( len(stats), total_added, total_removed ) )
+
+commands = {
+    'status':{'attr':'cmd_status','help':'Show status of files'},
+    'install':{'attr':'cmd_install','help':'Copy all the missing files to source'},
+    'diff':{'attr':'cmd_diff','help':'Show diff for modified files'},
+    'difftool':{'attr':'cmd_difftool','help':'Show diff for modified files in ksdiff or vimdiff'},
+    'sync':{'attr':'cmd_sync','help':'copy most recent files to older one'},
+    'pull':{'attr':'cmd_pull','help':'copy to local the original files'},
+    'push':{'attr':'cmd_push','help':'push local file to the original location'},
+    'cache':{'attr':'cmd_cache','help':'show hash cache info, or [list|prune|clear] it'},
+    'watch':{'attr':'cmd_watch','help':'sync then keep syncing files as they change'},
+    'restore':{'attr':'cmd_restore','help':'list snapshots, or [TIMESTAMP [FILES]] restore the files saved at that time'},
+    'fleet':{'attr':'cmd_fleet','help':'[status|push] compare or push files to all the hosts of the inventory'}
+}
+
+def build_parser():
     description = "\n".join( [ '  {}: {}'.format( k,v['help'] ) for (k,v) in commands.items() ] )
     
     parser = argparse.ArgumentParser( description='Check configuration', formatter_class=argparse.RawTextHelpFormatter )
@@ -539,14 +2166,29 @@ if __name__ == "__main__":
     parser.add_argument( '-e', '--execute', action='store_true', help='actually execute the commands otherwise just print' )
     parser.add_argument( '-v', '--verbose', action='store_true', help='verbose output' )
     parser.add_argument( '-t', '--difftool', choices=['auto','vimdiff','ksdiff'], default='auto' )
+    parser.add_argument( '--format', choices=['human','jsonl','porcelain'], help='output format of status', default='human' )
+    parser.add_argument( '-z', action='store_true', help='terminate porcelain status entries with NUL', default=False )
+    parser.add_argument( '--inventory', help='json file with the hosts for fleet, default .syncfiles-hosts' )
+    parser.add_argument( '--stat', action='store_true', help='diff only shows the number of lines changed per file', default=False )
     parser.add_argument( '--nogit', action='store_true', help='always search files without git', default=False )
+    parser.add_argument( '-j', '--jobs', type=int, help='number of threads used to compare files', default=1 )
+    parser.add_argument( '--debounce', type=float, help='seconds without events before watch syncs', default=0.2 )
+    parser.add_argument( '--poll', action='store_true', help='watch by polling the files instead of inotify', default=False )
+    parser.add_argument( '--interval', type=float, help='seconds between polls when watching by polling', default=1.0 )
+    parser.add_argument( '--nosnapshot', action='store_true', help='do not save files before overwriting them', default=False )
+    parser.add_argument( '--rehash', action='store_true', help='ignore the hash cache and rehash every file', default=False )
     parser.add_argument( 'files',    metavar='FILES', nargs='*' )
+    return parser
+
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
 
     command = Config(args)
 
     if args.command in commands:
         getattr(command,commands[args.command]['attr'])()
+        command.save_state()
     else:
         print( 'Invalid command "{}"'.format( args.command) )
         parser.print_help()
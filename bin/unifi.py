@@ -27,16 +27,16 @@
 import argparse
 import re
 import json
-import urllib3
 from pprint import pprint
 import os
-from lancheck import DeviceList,Device
-from requests import Session, Request
-from requests_toolbelt import SSLAdapter
 
 class UnifiController(object):
     #### SETUP #
     def __init__(self, verify_ssl=False):
+        # requests is only loaded once a command needs the controller
+        import urllib3
+        from requests import Session
+
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
         configpath = self.config_file_path()
@@ -177,6 +177,7 @@ class UnifiController(object):
             raise Exception('_id not found, cannot change info')
 
     def device_list_from_unifi(self):
+        from lancheck import DeviceList
         all = self.json()
         rv = DeviceList([])
         for one in all:
@@ -189,6 +190,7 @@ class UnifiController(object):
         return rv
         
     def device_from_unifi(self,one):
+        from lancheck import Device
         defs = { 'ip':'ipv4', 'name':'name', 'hostname':'hostname', 'mac':'mac', 'model':'model','_id':'_id' }
         
         info = {}
@@ -226,6 +228,7 @@ class UnifiController(object):
         return dev
 
     def wifi_devices_from_unifi(self,one):
+        from lancheck import DeviceList,Device
         main = self.device_from_unifi(one)
         if not main:
             return None
@@ -291,6 +294,7 @@ class Command :
 
 
     def cmd_pull_to_network(self):
+        from lancheck import DeviceList
         unifi = UnifiController()
         unifi.login()
         unifi.list_known_devices()
@@ -302,7 +306,7 @@ class Command :
         fields = list.build_fields(self.args.args, ['name','mac','ipv4','vendor'])
         list.display_human(fields)
 
-        devices = DeviceList.from_json(args.network,all=True)
+        devices = DeviceList.load(args.network,all=True)
         devices.update_with( list, override=['ipv4','frequency' ])
 
         devices.display_changes()
@@ -312,6 +316,7 @@ class Command :
         devices.save_as_json_logic(self.args.network,self.args.save,self.args.force)
 
     def cmd_push_to_unifi(self):
+        from lancheck import DeviceList
         unifi = UnifiController()
         unifi.login()
         unifi.list_known_devices()
@@ -322,7 +327,7 @@ class Command :
         list.update_with( clientlist )
         list.clear_changes()
         
-        devices = DeviceList.from_json(args.network,all=True)
+        devices = DeviceList.load(args.network,all=True)
         list.update_with( devices )
 
         list.display_changes(['name'])
@@ -331,6 +336,7 @@ class Command :
 
         
     def cmd_map_names(self):
+        from lancheck import DeviceList
         devices = DeviceList.from_json('network.json')
 
         unifi = UnifiController()
@@ -28,10 +28,7 @@ import getpass
 import argparse
 import re
 import json
-import urllib3
 from pprint import pprint,pformat
-from requests import Session, Request
-from requests_toolbelt import SSLAdapter
 
 class Bot(object):
     def __init__(self,json):
@@ -61,6 +58,10 @@ class Integration(object):
     
 class XcodeServer(object):
     def __init__(self,args):
+        # requests is only loaded once a command needs the server
+        import urllib3
+        from requests import Session
+
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         self.args = args
         self.config = { 'baseurl': 'https://localhost:20343' }